@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from PIL import Image
+from merkle import pMerkleTree, sha256, serialize_multiproof, verify_proofs
+from mconfig import config
+
+#######################################
+# Benchmarks
+#   python benchmark.py merkle --leaves 10000 100000 1000000
+#   python benchmark.py suite --images 64 512 --output bench.json
+#   python benchmark.py compare before.json after.json
+#######################################
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              check=True,
+                              cwd=os.path.dirname(
+                                  os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_images(n: int, size=512, seed=0) -> list:
+    """
+    Smooth random grayscale images (upsampled noise) as pHash fixtures
+    """
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 256, (16, 16), dtype=np.uint8)).resize(
+            (size, size), Image.Resampling.BICUBIC) for _ in range(n)
+    ]
+
+
+def write_files(images: list, folder: str) -> list:
+    files = []
+    for idx, img in enumerate(images):
+        path = os.path.join(folder, f"res-{idx}.png")
+        img.save(path)
+        files.append(path)
+    return files
+
+
+def bench_phash(hash_size: int, n_images: int) -> dict:
+    """
+    get_phash, create_phash_list, get_average_hash and get_phash_distance
+    on synthetic images of one hash_size
+    """
+    from phash_ctrl import pHashController
+    import utils
+
+    config["hash_size"] = hash_size
+    config["hash_cache"] = None
+    config["phash_multi_resolution"] = False
+    images = make_images(n_images)
+    with tempfile.TemporaryDirectory() as folder:
+        files = write_files(images, folder)
+        ctrl, list_s = timed(pHashController, files, config, False, False)
+
+    _, single_s = timed(lambda: [ctrl.get_phash(img) for img in images])
+    _, ave_s = timed(ctrl.get_average_hash, ctrl.phashes)
+
+    hashes = [str(h) for h in ctrl.phashes]
+    pairs = [(a, b) for a in hashes[:64] for b in hashes[:64]]
+    _, dist_s = timed(lambda: [utils.get_phash_distance(a, b) for a, b in pairs])
+    return {
+        "bench": "phash",
+        "hash_size": hash_size,
+        "images": n_images,
+        "get_phash_images_per_s": n_images / single_s,
+        "create_phash_list_images_per_s": n_images / list_s,
+        "get_average_hash_images_per_s": n_images / ave_s,
+        "get_phash_distance_pairs_per_s": pairs.__len__() / dist_s,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_false_positives(hash_size: int, n_hashes: int) -> dict:
+    """
+    All-pairs false positive comparison over random average hashes
+    """
+    from image_ctrl import pImageController
+    from mhash_ctrl import MultiHashController
+    from report_sink import pMultiSink
+
+    config["hash_size"] = hash_size
+    rng = np.random.default_rng(hash_size)
+    bits = rng.integers(0, 256, (n_hashes, hash_size * hash_size // 8),
+                        dtype=np.uint8)
+    mhashes = pd.DataFrame({
+        "value": "na",
+        "ave-hash": [row.tobytes().hex() for row in bits],
+        "name": [f"img-{i}" for i in range(n_hashes)],
+        "module": [f"module-{i}" for i in range(n_hashes)],
+    })
+    with tempfile.TemporaryDirectory() as folder:
+        config["reports_output"] = folder
+        ctrl = MultiHashController(pImageController(config), config)
+        ctrl.report_sink = pMultiSink([])  # Only the comparison is timed
+        df, fpos_s = timed(ctrl.create_mhash_false_positive_sheet, mhashes,
+                           "bench")
+    return {
+        "bench": "fpos",
+        "hash_size": hash_size,
+        "hashes": n_hashes,
+        "pairs": df.__len__(),
+        "pairs_per_s": df.__len__() / fpos_s,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_merkle_tree(n_leaves: int, max_proofs=1000) -> dict:
+    """
+    create_tree over leaf files and m_proof for a sample of leaves
+    """
+    from image_ctrl import pImageController
+    from mhash_ctrl import MultiHashController
+
+    config["hash_cache"] = None
+    rng = np.random.default_rng(n_leaves)
+    with tempfile.TemporaryDirectory() as folder:
+        files = []
+        for idx in range(n_leaves):
+            path = os.path.join(folder, f"leaf-{idx}.bin")
+            with open(path, "wb") as f:
+                f.write(rng.bytes(1024))
+            files.append(path)
+        config["reports_output"] = folder
+        ctrl = MultiHashController(pImageController(config), config)
+        _, tree_s = timed(ctrl.create_tree, files)
+
+    step = max(1, n_leaves // max_proofs)
+    indices = range(1, n_leaves + 1, step)
+    results, proof_s = timed(lambda: [ctrl.tree.m_proof(i) for i in indices])
+    assert all(results)
+    return {
+        "bench": "merkle_tree",
+        "leaves": n_leaves,
+        "create_tree_leaves_per_s": n_leaves / tree_s,
+        "m_proof_per_s": indices.__len__() / proof_s,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_isolated(fn, *args) -> dict:
+    """
+    Runs a benchmark in a fresh process so peak RSS is its own
+    """
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def run_suite(hash_sizes: list, image_counts: list, hash_counts: list,
+              leaf_counts: list) -> list:
+    rows = []
+    for hash_size in hash_sizes:
+        for n in image_counts:
+            rows.append(run_isolated(bench_phash, hash_size, n))
+        for n in hash_counts:
+            rows.append(run_isolated(bench_false_positives, hash_size, n))
+    for n in leaf_counts:
+        rows.append(run_isolated(bench_merkle_tree, n))
+    return rows
+
+
+def save_results(rows: list, path: str):
+    data = {
+        "commit": get_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": rows,
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
+
+
+def get_row_key(row: dict) -> tuple:
+    return tuple((k, v) for k, v in row.items() if isinstance(v, (int, str)))
+
+
+def compare_results(a_path: str, b_path: str) -> list:
+    """
+    Ratio b / a of every throughput metric of matching benchmark rows
+    """
+    with open(a_path) as f:
+        a = json.load(f)
+    with open(b_path) as f:
+        b = json.load(f)
+    before = {get_row_key(row): row for row in a["results"]}
+    rows = []
+    for row in b["results"]:
+        old = before.get(get_row_key(row))
+        if old is None:
+            continue
+        ratios = dict(get_row_key(row))
+        for k, v in row.items():
+            if isinstance(v, float) and old.get(k):
+                ratios[k] = v / old[k]
+        rows.append(ratios)
+    print(f"{a['commit']} -> {b['commit']} (ratio new / old)")
+    return rows
+
+
+def bench_merkle_proofs(n_leaves: int, max_proofs=100000) -> dict:
+    """
+    Batch inclusion proof and verification throughput for one tree size
+    """
+    entries = [sha256(i.to_bytes(8, "big")) for i in range(n_leaves)]
+    tree = pMerkleTree()
+    _, build_s = timed(tree.append_entries, entries)
+    root, root_s = timed(tree.get_state)
+
+    step = max(1, n_leaves // max_proofs)
+    indices = list(range(1, n_leaves + 1, step))
+    proofs, prove_s = timed(tree.prove_inclusion_batch, indices)
+
+    leaves = [tree.get_leaf(i) for i in indices]
+    results, verify_s = timed(verify_proofs, leaves, root, proofs)
+    assert all(r == "valid" for r in results)
+
+    multiproof = json.dumps(serialize_multiproof(proofs))
+    single = sum(json.dumps(p.serialize()).__len__() for p in proofs[:1000])
+    return {
+        "leaves": n_leaves,
+        "proofs": indices.__len__(),
+        "build_leaves_per_s": n_leaves / build_s,
+        "root_s": root_s,
+        "prove_per_s": indices.__len__() / prove_s,
+        "verify_per_s": indices.__len__() / verify_s,
+        "multiproof_bytes_per_proof": multiproof.__len__() / indices.__len__(),
+        "single_proof_bytes": single / min(1000, indices.__len__()),
+    }
+
+
+def print_rows(rows: list):
+    for row in rows:
+        print(" | ".join(f"{k}: {v:,.2f}" if isinstance(v, float) else
+                         f"{k}: {v}" for k, v in row.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the hashing, comparison and Merkle paths")
+    sub = parser.add_subparsers(dest="suite", required=True)
+    merkle_parser = sub.add_parser("merkle")
+    merkle_parser.add_argument("--leaves",
+                               type=int,
+                               nargs="+",
+                               default=[10000, 100000, 1000000])
+    merkle_parser.add_argument("--max-proofs", type=int, default=100000)
+    suite_parser = sub.add_parser("suite")
+    suite_parser.add_argument("--hash-sizes",
+                              type=int,
+                              nargs="+",
+                              default=config["hash_sizes"])
+    suite_parser.add_argument("--images",
+                              type=int,
+                              nargs="+",
+                              default=[64, 512])
+    suite_parser.add_argument("--hashes",
+                              type=int,
+                              nargs="+",
+                              default=[1000, 5000])
+    suite_parser.add_argument("--leaves",
+                              type=int,
+                              nargs="+",
+                              default=[1000, 10000])
+    suite_parser.add_argument("--output")
+    compare_parser = sub.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args()
+
+    if args.suite == "merkle":
+        print_rows(
+            [bench_merkle_proofs(n, args.max_proofs) for n in args.leaves])
+    elif args.suite == "suite":
+        rows = run_suite(args.hash_sizes, args.images, args.hashes,
+                         args.leaves)
+        print_rows(rows)
+        save_results(
+            rows, args.output or
+            f"{config['reports_output']}/benchmarks/bench-{get_commit()}.json")
+    elif args.suite == "compare":
+        print_rows(compare_results(args.before, args.after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import numpy as np
+
+#######################################
+# Packed-bit hashes and popcount Hamming distance
+#######################################
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)],
+                             dtype=np.uint8)
+
+    def _popcount(arr: np.ndarray) -> np.ndarray:
+        return _POPCOUNT_LUT[arr]
+
+
+def popcount(packed: np.ndarray) -> np.ndarray:
+    """
+    Number of set bits per row of a packed uint8 matrix
+    """
+    return _popcount(np.asarray(packed, dtype=np.uint8)).sum(axis=-1,
+                                                              dtype=np.int64)
+
+
+class pBitHash:
+    """
+    Compact perceptual hash backed by a packed uint8 array (MSB first).
+    The hex form matches str(imagehash.ImageHash).
+    """
+
+    def __init__(self, packed: np.ndarray, bit_len=None):
+        self.packed = np.ascontiguousarray(packed, dtype=np.uint8).ravel()
+        self.bit_len = int(bit_len or self.packed.size * 8)
+
+    @classmethod
+    def from_bool(cls, bits: np.ndarray):
+        bits = np.asarray(bits, dtype=bool).ravel()
+        return cls(np.packbits(bits), bits.size)
+
+    @classmethod
+    def from_imagehash(cls, image_hash):
+        return cls.from_bool(image_hash.hash)
+
+    @classmethod
+    def from_hex(cls, hex_str: str, bit_len=None):
+        bit_len = bit_len or hex_str.__len__() * 4
+        if bit_len % 8 == 0 and hex_str.__len__() * 4 == bit_len:
+            return cls(np.frombuffer(bytes.fromhex(hex_str), dtype=np.uint8),
+                       bit_len)
+        bit_str = format(int(hex_str, 16), f"0{bit_len}b")
+        return cls.from_bool(np.frombuffer(bit_str.encode(), np.uint8) == 49)
+
+    def to_bool(self) -> np.ndarray:
+        return np.unpackbits(self.packed, count=self.bit_len).astype(bool)
+
+    def hamming(self, other: "pBitHash") -> int:
+        return int(popcount(self.packed ^ other.packed))
+
+    def similarity(self, other: "pBitHash") -> float:
+        return 1.0 - self.hamming(other) / self.bit_len
+
+    def __sub__(self, other: "pBitHash") -> int:
+        return self.hamming(other)
+
+    def __len__(self):
+        return self.bit_len
+
+    def __eq__(self, other):
+        return isinstance(other, pBitHash) and self.bit_len == other.bit_len \
+            and np.array_equal(self.packed, other.packed)
+
+    def __hash__(self):
+        return hash((self.bit_len, self.packed.tobytes()))
+
+    def __str__(self):
+        if self.bit_len % 8 == 0:
+            return self.packed.tobytes().hex()
+        bit_str = "".join("1" if b else "0" for b in self.to_bool())
+        return "{:0>{width}x}".format(int(bit_str, 2),
+                                      width=-(-self.bit_len // 4))
+
+    def __repr__(self):
+        return f"pBitHash({self})"
+
+
+def pack_hashes(hashes: list) -> np.ndarray:
+    """
+    Stacks hex strings, ImageHash or pBitHash objects into a (N, bytes)
+    packed uint8 matrix
+    """
+    rows = []
+    for h in hashes:
+        if isinstance(h, pBitHash):
+            rows.append(h.packed)
+        elif hasattr(h, "hash"):
+            rows.append(np.packbits(np.asarray(h.hash, dtype=bool).ravel()))
+        else:
+            rows.append(pBitHash.from_hex(str(h)).packed)
+    if rows.__len__() == 0:
+        return np.empty((0, 0), dtype=np.uint8)
+    return np.stack(rows)
+
+
+def distance_matrix(A: np.ndarray, B: np.ndarray) -> np.ndarray:
+    """
+    Bit Hamming distances between all rows of A (N, bytes) and B (M, bytes)
+
+    :return: int matrix of shape (N, M)
+    """
+    A = np.atleast_2d(np.asarray(A, dtype=np.uint8))
+    B = np.atleast_2d(np.asarray(B, dtype=np.uint8))
+    return popcount(A[:, np.newaxis, :] ^ B[np.newaxis, :, :])
+
+
+def similarity_matrix(A: np.ndarray, B: np.ndarray, bit_len: int) -> np.ndarray:
+    """
+    Normalized similarity (1 - hamming / bit_len) between all rows of A and B
+    """
+    return 1.0 - distance_matrix(A, B) / bit_len
+
+
+def threshold_to_distance(threshold: float, bit_len: int) -> int:
+    """
+    Largest hamming distance whose normalized similarity is >= threshold
+    """
+    ham = np.arange(bit_len + 1)
+    valid = ham[1.0 - ham / bit_len >= threshold]
+    return int(valid.max()) if valid.size > 0 else -1
+
+
+def lower_triangle_pairs(A: np.ndarray,
+                         block_size=512,
+                         max_distance=None,
+                         distinct: tuple = ()):
+    """
+    Chunked all-pairs hamming distances over the lower triangle (i > j)
+    of a packed hash matrix. Memory is bounded by block_size**2.
+
+    :param A: Packed hashes of shape (N, bytes)
+    :param block_size: Rows/cols per block
+    :param max_distance: Only yield pairs with a distance <= max_distance
+    :param distinct: Integer label arrays of length N, pairs sharing a label
+                     in any of them are skipped
+    :return: Generator of (idx_a, idx_b, hamming) array triples
+    """
+    A = np.atleast_2d(np.asarray(A, dtype=np.uint8))
+    n = A.shape[0]
+    for i0 in range(0, n, block_size):
+        i1 = min(i0 + block_size, n)
+        rows = np.arange(i0, i1)
+        for j0 in range(0, i1, block_size):
+            j1 = min(j0 + block_size, i1)
+            cols = np.arange(j0, j1)
+            dist = distance_matrix(A[i0:i1], A[j0:j1])
+
+            mask = rows[:, np.newaxis] > cols[np.newaxis, :]
+            for labels in distinct:
+                mask &= labels[i0:i1, np.newaxis] != labels[np.newaxis, j0:j1]
+            if max_distance is not None:
+                mask &= dist <= max_distance
+
+            ii, jj = np.nonzero(mask)
+            if ii.size > 0:
+                yield rows[ii], cols[jj], dist[ii, jj]
+
+
+class pAverageHash:
+    """
+    Average perceptual hash from per-bit (weighted) set counts. A bit of the
+    APH is set when its count exceeds half of the total weight, which is
+    the floored median of the bits. Hashes can be added incrementally.
+    """
+
+    def __init__(self, bit_len: int):
+        self.bit_len = bit_len
+        self.counts = np.zeros(bit_len, dtype=np.float64)
+        self.total = 0.0
+
+    def add(self, bits: np.ndarray, weights=None, packed=False):
+        """
+        :param bits: 0/1 tensor (N, H, H) / (N, bit_len), or (N, bytes)
+                     uint8 rows of np.packbits when packed
+        :param weights: Optional weight per hash, defaults to 1
+        """
+        bits = np.asarray(bits)
+        if packed:
+            if bits.shape[-1] != (self.bit_len + 7) // 8:
+                raise ValueError("Packed bits do not match bit_len")
+            bits = np.unpackbits(np.atleast_2d(bits).astype(np.uint8),
+                                 axis=1, count=self.bit_len)
+        bits = bits.reshape(-1, self.bit_len)
+
+        if weights is None:
+            self.counts += bits.sum(axis=0, dtype=np.float64)
+            self.total += bits.shape[0]
+        else:
+            weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+            self.counts += weights @ bits.astype(np.float64)
+            self.total += float(weights.sum())
+        return self
+
+    def get_bits(self) -> np.ndarray:
+        return self.counts > self.total / 2
+
+    def get_hash(self) -> pBitHash:
+        return pBitHash.from_bool(self.get_bits())
+
+    def to_dict(self) -> dict:
+        return {
+            "bit_len": self.bit_len,
+            "counts": self.counts.tolist(),
+            "total": self.total
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "pAverageHash":
+        ave = cls(data["bit_len"])
+        ave.counts = np.array(data["counts"], dtype=np.float64)
+        ave.total = float(data["total"])
+        return ave
@@ -0,0 +1,157 @@
+import json
+import os
+import time
+from collections import namedtuple
+from fnmatch import fnmatch
+import utils
+from mconfig import config
+
+#######################################
+# Dataset catalog (os.scandir, persisted, mtime-incremental)
+#######################################
+
+# A variant file, e.g. single/<module>/res-0.5-<name>.png
+Variant = namedtuple(
+    "Variant",
+    ["path", "folder", "source", "module", "modifier", "value", "name",
+     "suffix"])
+
+RACY_NS = 2_000_000_000  # Dirs modified this close to a scan are re-listed
+
+
+def match(name: str, selector: str) -> bool:
+    """
+    fnmatch with glob's rule that "*" does not match hidden names
+    """
+    if name.startswith(".") and not selector.startswith("."):
+        return False
+    return fnmatch(name, selector)
+
+
+def parse_variant(path: str) -> Variant:
+    """
+    Splits "<modifier>-<value>-<name>.<ext>" of a (virtual) variant path,
+    suffix is the last "-" part as used by the manual mpls
+    """
+    folder, filename = os.path.split(path)
+    parts = os.path.splitext(filename)[0].split("-")
+    return Variant(path=path,
+                   folder=folder,
+                   source=os.path.basename(os.path.dirname(folder)),
+                   module=os.path.basename(folder),
+                   modifier=parts[0],
+                   value=parts[1] if parts.__len__() > 1 else "",
+                   name=parts[2] if parts.__len__() > 2 else "",
+                   suffix=parts[-1])
+
+
+class pCatalog:
+    """
+    Directory listings keyed by path. A listing is reused while the
+    directory's mtime is unchanged, so repeated selects and runs stat a
+    folder instead of re-reading it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dirs: dict = {}
+        self.variants: dict = {}
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.dirs = json.load(f).get("dirs", {})
+
+    def list_dir(self, folder: str) -> dict:
+        """
+        {"files": [...], "dirs": [...]} of a folder, sorted by name
+        """
+        key = os.path.normpath(folder)
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except FileNotFoundError:
+            self.dirs.pop(key, None)
+            return {"files": [], "dirs": []}
+
+        entry = self.dirs.get(key)
+        if entry is None or entry["mtime_ns"] != mtime_ns or \
+                mtime_ns >= entry["scanned_ns"] - RACY_NS:
+            files, dirs = [], []
+            with os.scandir(key) as it:
+                for e in it:
+                    (dirs if e.is_dir() else files).append(e.name)
+            entry = {
+                "mtime_ns": mtime_ns,
+                "scanned_ns": time.time_ns(),
+                "files": sorted(files),
+                "dirs": sorted(dirs)
+            }
+            self.dirs[key] = entry
+            self.dirty = True
+        return entry
+
+    def scan(self, root: str) -> int:
+        """
+        Walks (and refreshes) every folder below root
+
+        :return: Number of files
+        """
+        count = 0
+        todo = [root]
+        while todo:
+            folder = todo.pop()
+            entry = self.list_dir(folder)
+            count += entry["files"].__len__()
+            todo += [os.path.join(folder, d) for d in entry["dirs"]]
+        return count
+
+    def files(self, folder: str, selector="*") -> list:
+        """
+        Paths of the files in folder matching a glob selector, the
+        replacement of glob(f"{folder}{selector}")
+        """
+        return [
+            os.path.join(folder, name)
+            for name in self.list_dir(folder)["files"]
+            if match(name, selector)
+        ]
+
+    def folders(self, pattern: str) -> list:
+        """
+        Sub folders matching "<base>/*/", with a trailing separator like
+        glob returns them
+        """
+        base, selector = os.path.split(pattern.rstrip("/"))
+        return [
+            os.path.join(base, name, "")
+            for name in self.list_dir(base)["dirs"] if match(name, selector)
+        ]
+
+    def get_variant(self, path: str) -> Variant:
+        variant = self.variants.get(path)
+        if variant is None:
+            variant = self.variants[path] = parse_variant(path)
+        return variant
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        utils.create_dir(os.path.dirname(self.path) or ".")
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"dirs": self.dirs}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+catalog = None
+
+
+def get_catalog() -> pCatalog:
+    """
+    Process wide catalog persisted at config["catalog_path"]
+    """
+    global catalog
+    path = config.get("catalog_path")
+    if catalog is None or catalog.path != path:
+        catalog = pCatalog(path)
+    return catalog
@@ -0,0 +1,183 @@
+import json
+import os
+import sqlite3
+import time
+import utils
+from merkle import hash_files
+from mconfig import config
+
+#######################################
+# Content-addressed hash cache (SQLite)
+#######################################
+
+
+def get_phash_params(hash_size: int) -> str:
+    """
+    Cache key part of everything a pHash depends on besides the content
+    """
+    return json.dumps({
+        "hash_size": hash_size,
+        "high_freq_factor": config["high_freq_factor"],
+        "phash_resize_mode": config.get("phash_resize_mode")
+    }, sort_keys=True)
+
+
+class pHashCache:
+    """
+    Persistent cache of file digests and perceptual hashes.
+
+    files:  path + size + mtime -> sha256 of the content
+    hashes: sha256 + kind + params -> value
+    Both tables are evicted least recently used, each on its own.
+    """
+
+    def __init__(self, path: str, max_entries=1000000):
+        utils.create_dir(os.path.dirname(path) or ".")
+        self.path = path
+        self.max_entries = max_entries
+        self.pid = os.getpid()
+        # Concurrent stage processes wait for the writer instead of failing
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                digest BLOB, atime REAL);
+            CREATE INDEX IF NOT EXISTS files_atime ON files (atime);
+            CREATE TABLE IF NOT EXISTS hashes (
+                digest BLOB, kind TEXT, params TEXT, value BLOB, atime REAL,
+                PRIMARY KEY (digest, kind, params));
+            CREATE INDEX IF NOT EXISTS hashes_atime ON hashes (atime);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def file_digest(self, path: str) -> bytes:
+        """
+        sha256 of a file, only re-read when size or mtime changed
+        """
+        return self.file_digests([path])[0]
+
+    def file_digests(self, paths: list, workers=None) -> list:
+        """
+        sha256 of many files, changed ones are hashed in parallel
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        stats = [os.stat(path) for path in paths]
+        digests = []
+        for path, st in zip(paths, stats):
+            row = self.db.execute(
+                "SELECT digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_size, st.st_mtime_ns)).fetchone()
+            digests.append(None if row is None else row[0])
+
+        now = time.time()
+        hits = [(now, path) for path, digest in zip(paths, digests)
+                if digest is not None]
+        if hits.__len__() > 0:
+            self.db.executemany("UPDATE files SET atime = ? WHERE path = ?",
+                                hits)
+            self.db.commit()
+
+        missing = [idx for idx, digest in enumerate(digests) if digest is None]
+        if missing.__len__() > 0:
+            computed = hash_files([paths[idx] for idx in missing],
+                                  workers or config.get("merkle_workers", 8),
+                                  config.get("merkle_chunk_size", 1 << 20))
+            rows = []
+            for idx, digest in zip(missing, computed):
+                digests[idx] = digest
+                rows.append((paths[idx], stats[idx].st_size,
+                             stats[idx].st_mtime_ns, digest, now))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+            self.evict()
+        return digests
+
+    def get_many(self, digests: list, kind: str, params="") -> list:
+        """
+        Cached values (or None) aligned with digests
+        """
+        found = {}
+        for start in range(0, digests.__len__(), 500):
+            chunk = digests[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT digest, value FROM hashes WHERE kind = ? AND params = ? "
+                f"AND digest IN ({','.join('?' * chunk.__len__())})",
+                [kind, params] + chunk)
+            found.update(rows.fetchall())
+
+        if found.__len__() > 0:
+            now = time.time()
+            self.db.executemany(
+                "UPDATE hashes SET atime = ? WHERE digest = ? AND kind = ? AND params = ?",
+                [(now, d, kind, params) for d in found])
+            self.db.commit()
+        return [found.get(d) for d in digests]
+
+    def put_many(self, digests: list, kind: str, values: list, params=""):
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+            [(d, kind, params, bytes(v), now) for d, v in zip(digests, values)])
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Drops the least recently used entries above max_entries, per table.
+        File digests are kept without a hash, Merkle leaves only use those.
+        """
+        for table in ("hashes", "files"):
+            count = self.db.execute(
+                f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM "
+                    f"{table} ORDER BY atime LIMIT ?)",
+                    (count - self.max_entries, ))
+        self.db.commit()
+
+    def invalidate(self, kind: str, params: str):
+        """
+        Drops all entries of `kind` when its global parameters changed
+        since the last run
+        """
+        key = f"params:{kind}"
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key, )).fetchone()
+        if row is not None and row[0] != params:
+            self.db.execute("DELETE FROM hashes WHERE kind = ?", (kind, ))
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (key, params))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+hash_cache = None
+
+
+def get_hash_cache():
+    """
+    Process wide cache at config["hash_cache"], None when disabled
+    """
+    global hash_cache
+    path = config.get("hash_cache")
+    if path is None:
+        return None
+    # A forked worker must not share the parent's connection
+    if hash_cache is None or hash_cache.path != path or \
+            hash_cache.pid != os.getpid():
+        hash_cache = pHashCache(path,
+                                config.get("hash_cache_max_entries", 1000000))
+        hash_cache.invalidate(
+            "phash",
+            json.dumps(
+                {
+                    "high_freq_factor": config["high_freq_factor"],
+                    "phash_resize_mode": config.get("phash_resize_mode")
+                },
+                sort_keys=True))
+    return hash_cache
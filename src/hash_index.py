@@ -0,0 +1,166 @@
+import heapq
+import os
+import numpy as np
+from bithash import pBitHash, threshold_to_distance
+import utils
+
+#######################################
+# Hamming-space nearest neighbour index (BK-tree)
+#######################################
+
+
+class pHashIndex:
+    """
+    BK-tree over packed average perceptual hashes of one hash_size.
+    Radius and k-nearest queries prune subtrees with the triangle
+    inequality, inserts are incremental.
+    """
+
+    def __init__(self, hash_size: int):
+        self.hash_size = hash_size
+        self.bit_len = hash_size * hash_size
+        self.ids: list = []
+        self.values: list[int] = []  # Hashes as python ints for xor/bit_count
+        self.children: list[dict] = []  # Per node: edge distance -> node
+
+    def __len__(self):
+        return self.values.__len__()
+
+    def to_int(self, h) -> int:
+        """
+        Accepts a pBitHash, ImageHash, hex string or packed uint8 array
+        """
+        if isinstance(h, pBitHash):
+            packed = h.packed
+        elif hasattr(h, "hash"):
+            packed = pBitHash.from_imagehash(h).packed
+        elif isinstance(h, str):
+            packed = pBitHash.from_hex(h, self.bit_len).packed
+        else:
+            packed = np.asarray(h, dtype=np.uint8)
+        return int.from_bytes(packed.tobytes(), "big")
+
+    def insert(self, asset_id, h) -> int:
+        value = self.to_int(h)
+        idx = self.values.__len__()
+        self.ids.append(asset_id)
+        self.values.append(value)
+        self.children.append({})
+
+        node = 0
+        while idx > 0:
+            edge = (self.values[node] ^ value).bit_count()
+            child = self.children[node].get(edge)
+            if child is None:
+                self.children[node][edge] = idx
+                break
+            node = child
+        return idx
+
+    def query_radius(self, h, radius: int) -> list:
+        """
+        All entries within `radius` bits, sorted by distance
+
+        :return: List of (asset_id, hamming, normalized)
+        """
+        value = self.to_int(h)
+        result = []
+        stack = [0] if self.values.__len__() > 0 else []
+        while stack:
+            node = stack.pop()
+            d = (self.values[node] ^ value).bit_count()
+            if d <= radius:
+                result.append((d, node))
+            for edge, child in self.children[node].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        return self.__to_rows(sorted(result))
+
+    def query_threshold(self, h, threshold: float) -> list:
+        """
+        All entries with a normalized similarity >= threshold
+        """
+        return self.query_radius(h,
+                                 threshold_to_distance(threshold, self.bit_len))
+
+    def query_knn(self, h, k: int) -> list:
+        """
+        The k nearest entries, sorted by distance
+        """
+        if k <= 0:
+            return []
+        value = self.to_int(h)
+        best: list = []  # Max-heap of (-distance, -node)
+        stack = [0] if self.values.__len__() > 0 else []
+        while stack:
+            node = stack.pop()
+            d = (self.values[node] ^ value).bit_count()
+            if best.__len__() < k:
+                heapq.heappush(best, (-d, -node))
+            elif d < -best[0][0]:
+                heapq.heapreplace(best, (-d, -node))
+
+            tau = -best[0][0] if best.__len__() == k else self.bit_len
+            # Push far edges first so the closest subtree is visited next
+            for edge in sorted(self.children[node],
+                               key=lambda e: abs(e - d),
+                               reverse=True):
+                if d - tau <= edge <= d + tau:
+                    stack.append(self.children[node][edge])
+
+        return self.__to_rows(sorted((-d, -n) for d, n in best))
+
+    def __to_rows(self, result: list) -> list:
+        return [(self.ids[node], d, 1.0 - d / self.bit_len)
+                for d, node in result]
+
+    def save(self, path: str):
+        n = self.values.__len__()
+        n_bytes = (self.bit_len + 7) // 8
+        packed = np.frombuffer(
+            b"".join(v.to_bytes(n_bytes, "big") for v in self.values),
+            dtype=np.uint8).reshape(n, n_bytes)
+        parent = np.full(n, -1, dtype=np.int64)
+        edge = np.zeros(n, dtype=np.int64)
+        for node, children in enumerate(self.children):
+            for e, child in children.items():
+                parent[child] = node
+                edge[child] = e
+
+        utils.create_dir(os.path.dirname(path) or ".")
+        with open(path, "wb") as f:
+            np.savez(f,
+                     hash_size=self.hash_size,
+                     packed=packed,
+                     ids=np.array([str(i) for i in self.ids]),
+                     parent=parent,
+                     edge=edge)
+
+    @classmethod
+    def load(cls, path: str) -> "pHashIndex":
+        with np.load(path) as data:
+            index = cls(int(data["hash_size"]))
+            index.ids = data["ids"].tolist()
+            index.values = [
+                int.from_bytes(row.tobytes(), "big") for row in data["packed"]
+            ]
+            index.children = [{} for _ in index.values]
+            for child, (node, e) in enumerate(zip(data["parent"],
+                                                  data["edge"])):
+                if node >= 0:
+                    index.children[node][int(e)] = child
+        return index
+
+    @classmethod
+    def open(cls, folder: str, hash_size: int) -> "pHashIndex":
+        """
+        The index of hash_size saved in folder, empty when there is none
+        """
+        path = get_index_path(folder, hash_size)
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls(hash_size)
+
+
+def get_index_path(folder: str, hash_size: int) -> str:
+    return os.path.join(folder, f"aph-index-{hash_size}.npz")
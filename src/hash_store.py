@@ -0,0 +1,310 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import utils
+from bithash import pBitHash, pack_hashes, popcount, lower_triangle_pairs
+
+try:
+    import fcntl
+except ImportError:  # No advisory locks, single writer only
+    fcntl = None
+
+#######################################
+# Memory-mapped store of packed pHashes / APHs
+#######################################
+
+# Side table columns, strings are stored as codes into meta.json tables
+STRING_FIELDS = ("asset", "name", "modifier", "value", "image_set", "module")
+ROW_DTYPE = np.dtype([(field, np.int32) for field in STRING_FIELDS] +
+                     [("aph", np.int32)])
+
+
+class pHashStore:
+    """
+    Fixed-width on-disk store of one hash_size:
+
+    phash.bin: (count, row_bytes) packed pHashes
+    aph.bin:   (aph_count, row_bytes) packed APHs, one per image set
+    rows.bin:  (count,) ROW_DTYPE side table, aph indexes aph.bin
+    meta.json: sizes and string tables
+
+    Readers memory-map the files read-only, so several processes share the
+    same pages without copies. Appends go to the end of the files and only
+    become visible to readers once meta.json is replaced.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(self.__file("meta.json")) as f:
+            self.meta = json.load(f)
+        self.hash_size = self.meta["hash_size"]
+        self.bit_len = self.hash_size * self.hash_size
+        self.row_bytes = (self.bit_len + 7) // 8
+        self.codes = {
+            field: {s: idx
+                    for idx, s in enumerate(self.meta["strings"][field])}
+            for field in STRING_FIELDS
+        }
+        self.__maps: dict = {}
+
+    @classmethod
+    def create(cls, path: str, hash_size: int) -> "pHashStore":
+        """
+        Opens the store at path, creating an empty one if missing
+        """
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            utils.create_dir(path)
+            for name in ("phash.bin", "aph.bin", "rows.bin"):
+                open(os.path.join(path, name), "ab").close()
+            cls.write_meta(
+                path, {
+                    "hash_size": hash_size,
+                    "count": 0,
+                    "aph_count": 0,
+                    "strings": {field: []
+                                for field in STRING_FIELDS}
+                })
+        store = cls(path)
+        if store.hash_size != hash_size:
+            raise ValueError(
+                f"Store {path} holds hash_size {store.hash_size}, not {hash_size}")
+        return store
+
+    @staticmethod
+    def write_meta(path: str, meta: dict):
+        tmp = os.path.join(path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, "meta.json"))
+
+    def __file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def __map(self, name: str, dtype, shape: tuple) -> np.ndarray:
+        key = (name, shape)
+        if key not in self.__maps:
+            if shape[0] == 0:
+                self.__maps[key] = np.empty(shape, dtype=dtype)
+            else:
+                self.__maps[key] = np.memmap(self.__file(name),
+                                             dtype=dtype,
+                                             mode="r",
+                                             shape=shape)
+        return self.__maps[key]
+
+    @property
+    def phashes(self) -> np.ndarray:
+        return self.__map("phash.bin", np.uint8,
+                          (self.meta["count"], self.row_bytes))
+
+    @property
+    def aphs(self) -> np.ndarray:
+        return self.__map("aph.bin", np.uint8,
+                          (self.meta["aph_count"], self.row_bytes))
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self.__map("rows.bin", ROW_DTYPE, (self.meta["count"], ))
+
+    def refresh(self):
+        """
+        Picks up rows appended by other processes
+        """
+        with open(self.__file("meta.json")) as f:
+            self.meta = json.load(f)
+        self.codes = {
+            field: {s: idx
+                    for idx, s in enumerate(self.meta["strings"][field])}
+            for field in STRING_FIELDS
+        }
+
+    def column(self, field: str, rows=None) -> np.ndarray:
+        """
+        Decoded string column (of a row selection)
+        """
+        codes = self.rows[field] if rows is None else self.rows[field][rows]
+        return np.asarray(self.meta["strings"][field], dtype=object)[codes]
+
+    def __encode(self, field: str, values) -> np.ndarray:
+        codes = self.codes[field]
+        table = self.meta["strings"][field]
+        out = np.empty(values.__len__(), dtype=np.int32)
+        for idx, value in enumerate(values):
+            value = str(value)
+            if value not in codes:
+                codes[value] = table.__len__()
+                table.append(value)
+            out[idx] = codes[value]
+        return out
+
+    def append_set(self,
+                   phashes: np.ndarray,
+                   aph,
+                   metadata: dict,
+                   module: str,
+                   asset=None) -> range:
+        """
+        Appends the pHashes of one image set sharing one APH
+
+        :param phashes: Packed (N, row_bytes) or a list of hashes
+        :param aph: APH of the set (hex, ImageHash, pBitHash or packed)
+        :param metadata: Columns from pImageController.get_metadata
+        :param asset: Asset id, defaults to the module name
+        :return: Row indices of the appended hashes
+        """
+        if not isinstance(phashes, np.ndarray):
+            phashes = pack_hashes(phashes)
+        aph = aph if isinstance(aph, np.ndarray) else pack_hashes([aph])[0]
+        n = phashes.shape[0]
+        columns = {
+            "asset": [asset or module] * n,
+            "name": metadata["names"],
+            "modifier": metadata["modifier"],
+            "value": metadata["value"],
+            "image_set": metadata["image_set_type"],
+            "module": [module] * n
+        }
+        return self.append_rows(phashes, aph[np.newaxis], columns,
+                                np.zeros(n, dtype=np.int32))
+
+    def get_sets(self) -> set:
+        """
+        (module, packed APH bytes) of every stored image set
+        """
+        aph_idx, first = np.unique(self.rows["aph"], return_index=True)
+        modules = self.column("module", first)
+        return {(module, self.aphs[idx].tobytes())
+                for module, idx in zip(modules, aph_idx)}
+
+    def append_frame(self, df: pd.DataFrame, skip_existing=True) -> range:
+        """
+        Appends a create_mhash_average_sheet table, one APH per distinct
+        ave-hash. Image sets already stored (same module and APH) are
+        skipped, so re-running a stage does not duplicate rows.
+        """
+        if skip_existing and self.__len__() > 0:
+            existing = self.get_sets()
+            keep = [(module, pBitHash.from_hex(aph).packed.tobytes())
+                    not in existing for module, aph in zip(
+                        df["module"].astype(str), df["ave-hash"].astype(str))]
+            df = df[keep]
+        if df.__len__() == 0:
+            return range(self.__len__(), self.__len__())
+        aph_hex, aph_idx = np.unique(df["ave-hash"].astype(str),
+                                     return_inverse=True)
+        columns = {
+            "asset": df["module"].tolist(),
+            "name": df["name"].tolist(),
+            "modifier": df["mod"].tolist(),
+            "value": df["value"].tolist(),
+            "image_set": df["image_set"].tolist(),
+            "module": df["module"].tolist()
+        }
+        return self.append_rows(pack_hashes(df["phash"].astype(str).tolist()),
+                                pack_hashes(list(aph_hex)), columns,
+                                aph_idx.astype(np.int32))
+
+    def append_rows(self, phashes: np.ndarray, aphs: np.ndarray,
+                    columns: dict, aph_idx: np.ndarray) -> range:
+        """
+        Appends rows under an exclusive lock, aph_idx indexes aphs
+        """
+        phashes = np.ascontiguousarray(phashes, dtype=np.uint8)
+        aphs = np.ascontiguousarray(aphs, dtype=np.uint8)
+        if phashes.shape[1:] != (self.row_bytes, ) or \
+                aphs.shape[1:] != (self.row_bytes, ):
+            raise ValueError(f"Hashes do not match hash_size {self.hash_size}")
+
+        with open(self.__file("lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self.refresh()
+            start = self.meta["count"]
+            rows = np.zeros(phashes.shape[0], dtype=ROW_DTYPE)
+            for field in STRING_FIELDS:
+                rows[field] = self.__encode(field, columns[field])
+            rows["aph"] = aph_idx + self.meta["aph_count"]
+
+            # Truncate leftovers of an interrupted append before writing
+            for name, data, offset in (
+                ("phash.bin", phashes, start * self.row_bytes),
+                ("aph.bin", aphs, self.meta["aph_count"] * self.row_bytes),
+                ("rows.bin", rows, start * ROW_DTYPE.itemsize)):
+                with open(self.__file(name), "r+b") as f:
+                    f.truncate(offset)
+                    f.seek(offset)
+                    f.write(data.tobytes())
+
+            self.meta["count"] = start + phashes.shape[0]
+            self.meta["aph_count"] += aphs.shape[0]
+            self.write_meta(self.path, self.meta)
+        self.__maps = {}
+        return range(start, self.meta["count"])
+
+    def hamming_to_aph(self, block_size=1 << 16) -> np.ndarray:
+        """
+        Hamming distance of every pHash to the APH of its set, in blocks
+        """
+        out = np.empty(self.__len__(), dtype=np.int64)
+        for start in range(0, self.__len__(), block_size):
+            stop = min(start + block_size, self.__len__())
+            aph = self.aphs[self.rows["aph"][start:stop]]
+            out[start:stop] = popcount(self.phashes[start:stop] ^ aph)
+        return out
+
+    def query_radius(self, h, radius: int, block_size=1 << 16) -> np.ndarray:
+        """
+        APH indices within `radius` bits of h, scanned in blocks
+        """
+        if not isinstance(h, np.ndarray):
+            h = pack_hashes([h])[0]
+        found = []
+        for start in range(0, self.aphs.shape[0], block_size):
+            block = self.aphs[start:start + block_size]
+            found.append(np.nonzero(popcount(block ^ h) <= radius)[0] + start)
+        return np.concatenate(found) if found else np.empty(0, np.int64)
+
+    def aph_pairs(self, max_distance=None, block_size=512):
+        """
+        All-pairs APH comparison, see bithash.lower_triangle_pairs
+        """
+        aph_module = np.zeros(self.aphs.shape[0], dtype=np.int64)
+        aph_module[self.rows["aph"]] = self.rows["module"]
+        return lower_triangle_pairs(self.aphs,
+                                    block_size=block_size,
+                                    max_distance=max_distance,
+                                    distinct=(aph_module, ))
+
+    def get_aph(self, idx: int) -> pBitHash:
+        return pBitHash(self.aphs[idx], self.bit_len)
+
+    def to_frame(self, rows=slice(None)) -> pd.DataFrame:
+        """
+        Row selection as a table with hex hashes, for small selections
+        """
+        selected = self.rows[rows]
+        df = pd.DataFrame({
+            field: np.asarray(self.meta["strings"][field],
+                              dtype=object)[selected[field]]
+            for field in STRING_FIELDS
+        })
+        df.insert(
+            1, "phash",
+            [str(pBitHash(row, self.bit_len)) for row in self.phashes[rows]])
+        df.insert(2, "ave-hash", [
+            str(pBitHash(row, self.bit_len))
+            for row in self.aphs[selected["aph"]]
+        ])
+        return df
+
+
+def get_store_path(root: str, hash_size: int) -> str:
+    return os.path.join(root, f"hash-store-{hash_size}")
+
+
+def open_store(root: str, hash_size: int) -> pHashStore:
+    return pHashStore.create(get_store_path(root, hash_size), hash_size)
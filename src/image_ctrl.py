@@ -1,13 +1,37 @@
 from PIL import Image, ImageEnhance
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from profiler import profiler, profiled
+from catalog import get_catalog
 import os
 
 
+def run_image_task(ctrl, method: str, args: tuple, isolated=False) -> tuple:
+    """
+    Runs the per-file task method `method` of ctrl, returns the errors it
+    collected and, in a pool worker (isolated), the profile of the task
+    """
+    if isolated:
+        profiler.reset()
+    ctrl.errors = []
+    try:
+        with profiler.span(f"image.{method.lstrip('_')}",
+                           file=str(args[0])):
+            getattr(ctrl, method)(*args)
+    except Exception as e:
+        ctrl.add_error(args[0], e)
+    return ctrl.errors, profiler.to_dict() if isolated else None
+
+
 class pImageController:
-    verbose = False
 
     def __init__(self, config: dict):
         self.config = config
+        self.errors: list = []
+
+    def add_error(self, file_path: str, e: Exception):
+        self.errors.append((file_path, f"{type(e).__name__}: {e}"))
 
     def get_config(self, key: str):
         return self.config[key]
@@ -15,8 +39,8 @@ class pImageController:
     def get_output_path(self, suffix=""):
         return f"./assets/output/{suffix}"
 
-    def resize_image(self, img: Image.Image, file_path: str,
-                     scale_width: float, folder: str):
+    def get_resized_image(self, img: Image.Image, file_path: str,
+                          scale_width: float) -> Image.Image:
         """
             Resize image based on width
         """
@@ -32,22 +56,29 @@ class pImageController:
         if resized_img.height < 32:
             print("=== Warning - low height: ", resized_img.height, file_path)
 
+        return resized_img
+
+    def resize_image(self, img: Image.Image, file_path: str,
+                     scale_width: float, folder: str):
+        resized_img = self.get_resized_image(img, file_path, scale_width)
         self.save_image(resized_img, file_path, folder, f"res-{scale_width}-")
 
+    def get_output_filename(self, file_path: str) -> str:
+        return os.path.basename(file_path).replace("-", "_").lower().replace(
+            ".brd", "")
+
     def save_image(self,
                    img: Image.Image,
                    file_path: str,
                    folder: str,
                    prefix=""):
-        filename = os.path.basename(file_path).replace("-",
-                                                       "_").lower().replace(
-                                                           ".brd", "")
+        filename = self.get_output_filename(file_path)
         os_path = os.path.join(self.get_output_path(self.output_folder),
                                folder)
-        if not os.path.exists(os_path):
-            os.makedirs(os_path)
+        os.makedirs(os_path, exist_ok=True)
 
-        img.save(os.path.join(os_path, f"{prefix}{filename}"))
+        with profiler.timer("image.png_write"):
+            img.save(os.path.join(os_path, f"{prefix}{filename}"))
 
     def crop_image(self, img: Image.Image, crop_scale: float):
         """
@@ -65,10 +96,12 @@ class pImageController:
                 int(w2 + crop_width2), int(h2 + crop_hight2))
         return img.crop(rect)
 
-    def manipulate_image(self, img: Image.Image, file_path: str, folder: str):
+    def iter_manipulations(self, img: Image.Image):
         """
-            Distributes random image tiles through the image
+            Distributes random image tiles through the image, yields
+            (prefix, image) after every tile
         """
+        img = img.copy()
         w, h = img.size
         t_size = self.get_config("mpl_tile_sizes")
         t_angel = self.get_config("mpl_tile_angle")
@@ -80,48 +113,71 @@ class pImageController:
             crop_rect = (w2 - tile_size2, h2 - tile_size2, w2 + tile_size2,
                          h2 + tile_size2)
             cropped_img = img.crop(crop_rect).rotate(angle)
-            cropped_img.copy()
 
             img.paste(cropped_img, (crop_rect[0], crop_rect[1]))
-            self.save_image(img, file_path, folder,
-                            f"mpl-rotate_{angle}_{mpl_tile_size}-")
+            yield f"mpl-rotate_{angle}_{mpl_tile_size}-", img.copy()
 
-    def __create_images_colorize(self, img: Image.Image, file_path: str,
-                                 folder: str):
+    def manipulate_image(self, img: Image.Image, file_path: str, folder: str):
+        for prefix, mpl_img in self.iter_manipulations(img):
+            self.save_image(mpl_img, file_path, folder, prefix)
+
+    def __iter_colorize(self, img: Image.Image, file_path: str):
         try:
             enhancer = ImageEnhance.Brightness(img)
             lighter = enhancer.enhance(1.5)
             darker = enhancer.enhance(0.5)
-            self.save_image(lighter, file_path, folder, "mpl-color_lighter-")
-            self.save_image(darker, file_path, folder, "mpl-color_darker-")
-
         except Exception as e:
-            print(f"An error occurred: {e}")
+            self.add_error(file_path, e)
+            return
+
+        yield "mpl-color_lighter-", lighter
+        yield "mpl-color_darker-", darker
 
-    def __create_image_set(self, file_path: str, module_name: str,
+    def iter_image_set(self, img: Image.Image, file_path: str,
+                       res_only: bool):
+        """
+            Yields (prefix, image) for every variant of an RGB image
+        """
+        # Normal image
+        yield "res-na-", img
+
+        # Resolutions
+        for scale in self.get_config("resolution_scale_width"):
+            yield f"res-{scale}-", self.get_resized_image(
+                img, file_path, scale)
+
+        # Colored
+        if res_only == False:
+            yield from self.__iter_colorize(img, file_path)
+        # Manipulations
+        if res_only == False:
+            yield from self.iter_manipulations(img)
+
+    def iter_cropped_image_set(self, img: Image.Image, pre_crop_frame: float):
+        """
+        Crops image with percents of size
+        85% of the image are used as reference to avoid black frames etc.
+        """
+        if pre_crop_frame != None and pre_crop_frame > 0:
+            img = self.crop_image(img, pre_crop_frame)
+        yield "res-na-", img
+
+        for crop_size in self.get_config("crop_sizes"):
+            yield f"cropped-{crop_size*100}-", self.crop_image(img, crop_size)
+
+    def _create_image_set(self, file_path: str, module_name: str,
                            res_only: bool):
         try:
             with Image.open(file_path) as img:
                 img = img.convert('RGB')
-
-                # Normal image
-                self.save_image(img, file_path, module_name, "res-na-")
-
-                # Resolutions
-                for scale in self.get_config("resolution_scale_width"):
-                    self.resize_image(img, file_path, scale, module_name)
-
-                # Colored
-                if res_only == False:
-                    self.__create_images_colorize(img, file_path, module_name)
-                # Manipulations
-                if res_only == False:
-                    self.manipulate_image(img, file_path, module_name)
+                for prefix, variant in self.iter_image_set(
+                        img, file_path, res_only):
+                    self.save_image(variant, file_path, module_name, prefix)
 
         except Exception as e:
-            print(f"An error occurred: {e}")
+            self.add_error(file_path, e)
 
-    def __create_grid_set(self, file_path: str, module_name: str):
+    def _create_grid_set(self, file_path: str, module_name: str):
         try:
             with Image.open(file_path) as img:
                 img = img.convert('RGB')
@@ -132,34 +188,128 @@ class pImageController:
                 # TODO: Build grids 2,4,8,16
 
         except Exception as e:
-            print(f"An error occurred: {e}")
+            self.add_error(file_path, e)
 
-    def __create_copped_image_set(self, file_path: str, module_name: str,
+    def _create_copped_image_set(self, file_path: str, module_name: str,
                                   pre_crop_frame: float):
-        """
-        Crops image with percents of size
-        85% of the image are used as reference to avoid black frames etc.
-        """
         self.output_folder = "cropped"
         with Image.open(file_path) as img:
-            if pre_crop_frame != None and pre_crop_frame > 0:
-                img = self.crop_image(img, pre_crop_frame)
-            self.save_image(img, file_path, module_name, "res-na-")
-
-            for crop_size in self.get_config("crop_sizes"):
-                cropped_img = self.crop_image(img, crop_size)
-                self.save_image(cropped_img, file_path, module_name,
-                                f"cropped-{crop_size*100}-")
+            for prefix, variant in self.iter_cropped_image_set(
+                    img, pre_crop_frame):
+                self.save_image(variant, file_path, module_name, prefix)
 
-    def __create_version_image_set(self, file_path: str, module_name: str):
-        files = glob(f"{file_path}*")
-        for file in files:
-            self.__create_image_set(file, module_name, True)
+    def __stream_image_sets(self, groups: list, persist: tuple):
+        """
+            Yields (folder, [(path, image), ...]) per module. Paths are the
+            ones the disk-based generation would write, only variants whose
+            file name matches a `persist` pattern are saved.
+        """
+        folders = [
+            os.path.join(self.get_output_path(self.output_folder),
+                         module_name, "") for module_name, _, _ in groups
+        ]
+        # Same folder order as the sorted glob of the disk-based path
+        for folder, (module_name, file_paths, iter_variants) in sorted(
+                zip(folders, groups), key=lambda g: g[0]):
+            variants = []
+            for file_path in file_paths:
+                filename = self.get_output_filename(file_path)
+                try:
+                    with Image.open(file_path) as img:
+                        for prefix, variant in iter_variants(img, file_path):
+                            variant.load()
+                            profiler.count("image.variants")
+                            name = f"{prefix}{filename}"
+                            variants.append((f"{folder}{name}", variant))
+                            if any(fnmatch(name, p) for p in persist):
+                                self.save_image(variant, file_path,
+                                                module_name, prefix)
+                except Exception as e:
+                    self.add_error(file_path, e)
+            yield folder, variants
+
+    def stream_single_images(self,
+                             output_folder: str,
+                             input: str,
+                             stop_after=None,
+                             persist=()):
+        """
+            In-memory counterpart of generate_single_images
+        """
+        self.output_folder = output_folder
+        self.errors = []
+        files = self.__limit(glob(input), stop_after)
+        iter_variants = lambda img, file_path: self.iter_image_set(
+            img.convert('RGB'), file_path, False)
+        groups = [(self.get_module_name(glob(file)), [file], iter_variants)
+                  for file in files]
+        return self.__stream_image_sets(groups, persist)
+
+    def stream_images_versions(self, stop_after=None, persist=()):
+        """
+            In-memory counterpart of generate_images_versions
+        """
+        self.output_folder = "versions/"
+        self.errors = []
+        version_folders = self.__limit(
+            glob("./assets/original/versions/*/", recursive=True), stop_after)
+        iter_variants = lambda img, file_path: self.iter_image_set(
+            img.convert('RGB'), file_path, True)
+        groups = [(self.get_module_name(glob(f"{folder}*")),
+                   glob(f"{folder}*"), iter_variants)
+                  for folder in version_folders]
+        return self.__stream_image_sets(groups, persist)
+
+    def stream_images_cropped(self,
+                              pre_crop_frame: float,
+                              stop_after=None,
+                              persist=()):
+        """
+            In-memory counterpart of generate_images_cropped
+        """
+        self.output_folder = "cropped/"
+        self.errors = []
+        files = self.__limit(glob("./assets/original/single/*"), stop_after)
+        iter_variants = lambda img, file_path: self.iter_cropped_image_set(
+            img, pre_crop_frame)
+        groups = [(self.get_module_name(glob(file)), [file], iter_variants)
+                  for file in files]
+        return self.__stream_image_sets(groups, persist)
+
+    def __run_tasks(self, method: str, tasks: list) -> list:
+        """
+            Runs per-file tasks serially or on a pool of config["image_workers"]
+            processes (0 := all cores) and collects their errors
+        """
+        workers = self.config.get("image_workers")
+        self.errors = []
+        profiler.count("image.source_files", tasks.__len__())
 
-    def __create_gerbers_image_set(self, file_path: str, module_name: str):
-        files = glob(f"{file_path}*/*")
-        for file in files:
-            self.__create_image_set(file, module_name, False)
+        if workers is None or workers == 1 or tasks.__len__() < 2:
+            for args in tasks:
+                self.errors += run_image_task(self, method, args)[0]
+        else:
+            with ProcessPoolExecutor(max_workers=workers or None) as executor:
+                futures = [
+                    executor.submit(run_image_task, self, method, args, True)
+                    for args in tasks
+                ]
+                for future in futures:
+                    errors, worker_profile = future.result()
+                    self.errors += errors
+                    profiler.merge(worker_profile)
+
+        for file_path, error in self.errors:
+            print(f"An error occurred: {error} ({file_path})")
+        return self.errors
+
+    def __limit(self, items: list, stop_after=None) -> list:
+        """
+            Keeps the first stop_after items (at least one)
+        """
+        if stop_after is None:
+            return items
+        return items[:max(stop_after, 1)]
 
     def get_module_name(self, files: list) -> str:
         """
@@ -181,72 +331,70 @@ class pImageController:
             "names": [],
             "image_set_type": []
         })
+        catalog = get_catalog()
         for file in hashes:
-            splitted = self.get_module_name([file]).split("-")
-            metadata["modifier"].append(splitted[0])
-            metadata["value"].append(splitted[1])
-            metadata["names"].append(splitted[2])
+            variant = catalog.get_variant(file)
+            metadata["modifier"].append(variant.modifier)
+            metadata["value"].append(variant.value)
+            metadata["names"].append(variant.name)
             metadata["image_set_type"].append(image_set_type)
         return metadata
 
+    @profiled("image.generate_single_images")
     def generate_single_images(self,
                                output_folder: str,
                                input: str,
-                               stop_after=None):
+                               stop_after=None) -> list:
         self.output_folder = output_folder
-        files = glob(input)
-        for idx, file in enumerate(files):
-            module_name = self.get_module_name(glob(file))
-            self.__create_image_set(file, module_name, False)
-            if stop_after != None and idx > stop_after - 2:
-                break
+        files = self.__limit(glob(input), stop_after)
+        tasks = [(file, self.get_module_name(glob(file)), False)
+                 for file in files]
+        return self.__run_tasks("_create_image_set", tasks)
 
+    @profiled("image.generate_grid_images")
     def generate_grid_images(self,
                              output_folder: str,
                              input: str,
-                             stop_after=None):
+                             stop_after=None) -> list:
         self.output_folder = output_folder
-        files = glob(input)
-        for idx, file in enumerate(files):
-            module_name = self.get_module_name(glob(file))
-            self.__create_grid_set(file, module_name)
-            if stop_after != None and idx > stop_after - 2:
-                break
-
-    def generate_images_versions(self, stop_after=None):
+        files = self.__limit(glob(input), stop_after)
+        tasks = [(file, self.get_module_name(glob(file))) for file in files]
+        return self.__run_tasks("_create_grid_set", tasks)
+
+    @profiled("image.generate_images_versions")
+    def generate_images_versions(self, stop_after=None) -> list:
         self.output_folder = "versions/"
-        version_folders = glob("./assets/original/versions/*/", recursive=True)
+        version_folders = self.__limit(
+            glob("./assets/original/versions/*/", recursive=True), stop_after)
 
-        for idx, folder in enumerate(version_folders):
+        tasks = []
+        for folder in version_folders:
             module_name = self.get_module_name(glob(f"{folder}*"))
-            files = glob(folder)
-
-            # print(f"Created: {module_name}")
-            for file in files:
-                self.__create_version_image_set(file, module_name)
-            if stop_after != None and idx > stop_after - 2:
-                break
+            for file_path in glob(folder):
+                tasks += [(file, module_name, True)
+                          for file in glob(f"{file_path}*")]
+        return self.__run_tasks("_create_image_set", tasks)
 
-    def generate_images_gerbers(self, stop_after=None):
+    @profiled("image.generate_images_gerbers")
+    def generate_images_gerbers(self, stop_after=None) -> list:
         self.output_folder = "gerbers/"
-        version_folders = glob("./assets/original/gerbers_png/*",
-                               recursive=True)
+        version_folders = self.__limit(
+            glob("./assets/original/gerbers_png/*", recursive=True),
+            stop_after)
 
-        for idx, folder in enumerate(version_folders):
+        tasks = []
+        for folder in version_folders:
             module_name = self.get_module_name(glob(f"{folder}*"))
-            files = glob(folder)
-
-            for file in files:
-                self.__create_gerbers_image_set(file, module_name)
-            if stop_after != None and idx > stop_after - 2:
-                break
-
-    def generate_images_cropped(self, pre_crop_frame: float, stop_after=None):
+            for file_path in glob(folder):
+                tasks += [(file, module_name, False)
+                          for file in glob(f"{file_path}*/*")]
+        return self.__run_tasks("_create_image_set", tasks)
+
+    @profiled("image.generate_images_cropped")
+    def generate_images_cropped(self, pre_crop_frame: float,
+                                stop_after=None) -> list:
         self.output_folder = "cropped/"
-        files = glob("./assets/original/single/*")
-
-        for idx, file in enumerate(files):
-            module_name = self.get_module_name(glob(file))
-            self.__create_copped_image_set(file, module_name, pre_crop_frame)
-            if stop_after != None and idx > stop_after - 2:
-                break
+        files = self.__limit(glob("./assets/original/single/*"), stop_after)
+        tasks = [(file, self.get_module_name(glob(file)), pre_crop_frame)
+                 for file in files]
+        return self.__run_tasks("_create_copped_image_set", tasks)
@@ -1,127 +1,96 @@
-from image_ctrl import pImageController
-from mhash_ctrl import MultiHashController
-from mconfig import config, All, Some
-import reporter
-import utils
+import argparse
+from mconfig import config
+from profiler import profiler, save_run_profile
+from runner import IMAGE_SETS, build_pipeline, get_pipeline_settings, \
+    pJobRunner
 
 #######################################
 ######### Execution config ############
+#   python main.py                        all stages, up-to-date ones skipped
+#   python main.py --stages "report" --excel   a report and its inputs
+#   python main.py --stages "hash:single:*" --hash-sizes 8 16 --force
+#   python main.py --list
 #######################################
-run_image_generation = True  # Just need to be done once
-run_version = All
-run_single = All
-run_crop = All
-run_grid_mpl = None
-run_mpls = All
-run_wires_only = All
-run_reports = All
-#######################################
-
-# Clean outputs (Exclude manual modified gerbers)
-if run_image_generation:
-    utils.delete_folder("./assets/output/cropped/*/")
-    utils.delete_folder("./assets/output/grid/*/")
-    utils.delete_folder("./assets/output/single/*/")
-    utils.delete_folder("./assets/output/versions/*/")
-    utils.delete_folder("./assets/output/wires_only/*/")
-
-if run_reports:
-    utils.delete_files("./reports/*.xlsx")
-
-for hash_size in config["hash_sizes"]:
-    config["hash_size"] = hash_size
-    img_ctrl = pImageController(config)
-    mhash_ctrl = MultiHashController(img_ctrl, config)
-
-    # Manual mpls
-    if run_mpls != None and run_mpls > 0:
-        mhash_ctrl.create_mpls_sheet()
-
-    # Single image-set
-    if run_single != None and run_single > 0:
-        if run_image_generation:
-            img_ctrl.generate_single_images(output_folder="single/",
-                                            input="./assets/original/single/*",
-                                            stop_after=run_single)
-        df_single = mhash_ctrl.create_mhash_average_sheet(
-            "single/*/", "res-*", "mpl-*", "single")
-        mhash_ctrl.create_mhash_false_positive_sheet(df_single, "single")
-
-    # Wires only set
-    if run_wires_only != None and run_wires_only > 0:
-        if run_image_generation:
-            img_ctrl.generate_single_images(
-                output_folder="wires_only/",
-                input="./assets/original/gerbers/wires_only/*",
-                stop_after=run_wires_only)
-        df_wires = mhash_ctrl.create_mhash_average_sheet(
-            "wires_only/*/", "res-*", "mpl-*", "wires_only")
-        mhash_ctrl.create_mhash_false_positive_sheet(df_wires,
-                                                     "run_wires_only")
-
-    # Cropped (on single)
-    if run_crop != None and run_crop > 0:
-        if run_image_generation:
-            img_ctrl.generate_images_cropped(stop_after=run_crop,
-                                             pre_crop_frame=0.95)
-        df_crop = mhash_ctrl.create_mhash_average_sheet(
-            "cropped/*/", "res-*", "cropped-*", "single", False)
-
-    # Versions image-set
-    # if run_version != None and run_version > 0:
-    #     if run_image_generation:
-    #         img_ctrl.generate_images_versions(stop_after=run_version)
-    #     df_versions = mhash_ctrl.create_mhash_average_sheet(
-    #         input_folder="versions/*/",
-    #         ave_selector="res-*",
-    #         target_selector="res-*",
-    #         image_set_type="versions")
-    #     mhash_ctrl.create_mhash_false_positive_sheet(df_versions, "versions")
-
-    # Versions image-set baseline
-    if run_version != None and run_version > 0:
-        if run_image_generation:
-            img_ctrl.generate_images_versions(stop_after=run_version)
-        df_versions = mhash_ctrl.create_mhash_average_sheet(
-            input_folder="versions/*/",
-            ave_selector="res-*",
-            target_selector="res-*",
-            image_set_type="versions")
-        #mhash_ctrl.create_mhash_false_positive_sheet(df_versions, "versions")
-
-if run_reports:
-    # Create reports
-    out = config.get('reports_output')
-
-    if run_crop != None and run_crop > 0:
-        reporter.create_crop_report()
-
-    # Creates the ave hash form res-* images and checks them against the manipulated images
-    if run_single != None and run_single > 0:
-        reporter.create_ave_report(f"{out}/hash-*-single-output.xlsx",
-                                   "single")
-        reporter.create_fpos_report(f"{out}/hash-*-single-fpos-output.xlsx",
-                                    "single")
-
-    # Creates the ave hash form res-* images of all versions and checks them against the single res-* images
-    if run_version != None and run_version > 0:
-        reporter.create_ave_report(f"{out}/hash-*-versions-output.xlsx",
-                                   "versions")
-        reporter.create_fpos_report(f"{out}/hash-*-versions-fpos-output.xlsx",
-                                    "versions")
 
-    if run_mpls != None and run_mpls > 0:
-        reporter.create_mpls_report(
-            f"{out}/hash-*-mpl_conduct_layout-output.xlsx", "conduct_layout")
-        reporter.create_mpls_report(f"{out}/hash-*-mpl_elements-output.xlsx",
-                                    "elements")
-        reporter.create_mpls_report_wires(
-            f"{out}/hash-*-mpl_conduct_width-output.xlsx", "conduct_width")
-        reporter.create_mpls_report_wires_only2(
-            f"{out}/hash-*-wire_only_mpls-output.xlsx", "wires_only_mpls")
 
-    if run_wires_only != None and run_wires_only > 0:
-        reporter.create_ave_report(f"{out}/hash-*-wires_only-output.xlsx",
-                                   "wires_only")
-        reporter.create_fpos_report(
-            f"{out}/hash-*-run_wires_only-fpos-output.xlsx", "wires_only")
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the hash, compare and report stage graph")
+    parser.add_argument("--stages",
+                        nargs="+",
+                        help="Stage name patterns, e.g. hash:* or report")
+    parser.add_argument("--hash-sizes",
+                        type=int,
+                        nargs="+",
+                        default=config["hash_sizes"])
+    parser.add_argument("--sets",
+                        nargs="+",
+                        choices=list(IMAGE_SETS),
+                        default=list(IMAGE_SETS))
+    parser.add_argument("--limit",
+                        type=int,
+                        help="Source files per image set (stop_after)")
+    parser.add_argument("--in-memory",
+                        action="store_true",
+                        help="Hash variants in memory instead of writing "
+                        "PNGs. Each hash size streams them again, so it pays "
+                        "off for few sizes, and --multi-resolution has no "
+                        "effect")
+    parser.add_argument("--persist",
+                        nargs="*",
+                        default=[],
+                        help="In-memory variants to save anyway, e.g. mpl-*")
+    parser.add_argument("--no-mpls", action="store_true")
+    parser.add_argument("--no-report", action="store_true")
+    parser.add_argument("--excel",
+                        action="store_true",
+                        default=config.get("report_excel", False),
+                        help="Write the Excel workbooks, the report stage "
+                        "only runs with them")
+    parser.add_argument("--multi-resolution",
+                        action="store_true",
+                        help="Hash all sizes per decode, for --workers 1")
+    parser.add_argument("--workers",
+                        type=int,
+                        help="Concurrent stage processes, 1 runs inline")
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="Re-run stages even when up to date")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--list", action="store_true")
+    parser.add_argument("--state", default="./assets/cache/runner-state.json")
+    args = parser.parse_args()
+
+    config["hash_sizes"] = args.hash_sizes
+    # Stages hash one size each, sharing decodes only pays off inline
+    config["phash_multi_resolution"] = args.multi_resolution
+    config.update(get_pipeline_settings(args.excel))
+
+    stages = build_pipeline(args.hash_sizes,
+                            args.sets,
+                            limit=args.limit,
+                            in_memory=args.in_memory,
+                            persist=args.persist,
+                            mpls=not args.no_mpls,
+                            report=args.excel and not args.no_report)
+    runner = pJobRunner(stages, args.state, args.workers, args.force)
+
+    if args.list:
+        for name in runner.select(args.stages):
+            deps = ", ".join(runner.stages[name].deps)
+            print(name, f"<- {deps}" if deps else "")
+        return
+
+    status = runner.run(args.stages, args.dry_run)
+    for state in ("done", "skipped", "failed", "blocked"):
+        names = [name for name, s in status.items() if s == state]
+        if names.__len__() > 0:
+            print(f"{state}: {names.__len__()}")
+
+    if config.get("profile_output") is not None and not args.dry_run:
+        profiler.print_summary()
+        print("Profile:", save_run_profile())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 #######################################
 # Hash and Image configuration
 #######################################
@@ -9,10 +11,39 @@ config = {
     "crop_sizes": [0.97, 0.98, 0.99],
     "mpl_tile_sizes": [0.1, 1],
     "mpl_tile_angle": [90, 180],
+    "image_workers": None,  # Processes for image generation, 0 := all cores
     "reports_output": "./reports",
+    "report_formats": ["parquet"],  # Columnar tables: parquet and/or feather
+    "report_excel": False,  # Legacy full-table xlsx for the reporter
     "hash_sizes": [4, 8, 16, 32],
     "high_freq_factor": 6,
     "phash_resize_mode": "nofit",
+    "phash_batch_size": 512,  # Images per vectorized DCT pass
+    "phash_multi_resolution": False,  # Hash all hash_sizes per decode
+    "baseline_hashes": [],  # Eager dhash/average_hash/whash, else lazy
+    # Per user, cached file digests are keyed by absolute path. None disables
+    "hash_cache": os.path.join(os.path.expanduser("~"), ".cache", "mhash",
+                               "hashes.sqlite"),
+    "hash_cache_max_entries": 1000000,
+    "fpos_block_size": 512,  # Rows per all-pairs comparison block
+    "fpos_only_valid": False,  # Only write pairs above ave_threshold
+    "aph_index_path": "./assets/index",
+    "catalog_path": "./assets/cache/catalog.json",  # Cached dir listings
+    "hash_store": None,  # Memory-mapped hash store root, e.g. ./assets/store
+    "merkle_workers": 8,  # Threads hashing Merkle leaves
+    "merkle_chunk_size": 1048576,  # Read buffer per file in bytes
+    "gerber_hash_oversample": 2,  # Direct gerber raster / pHash input size
+    "gerber_hash_tolerance": 0.9,  # Min similarity direct vs. png path
+    "profile_output": "./reports/profiles",  # None disables the run profile
+    "profile_stages": [],  # Span names additionally run under cProfile
+    "roc_output": "./reports/roc",  # FAR/FRR curve exports of roc.py
+    "server_workers": 2,  # Hashing processes of the fingerprint server
+    "server_queue_size": 64,  # Queued requests before 503 responses
+    "server_batch_size": 16,  # Requests hashed in one pool task
+    "server_batch_window": 0.01,  # Seconds a batch waits to fill up
+    "server_max_body": 268435456,  # Max bundle size in bytes
+    "server_max_unpacked": 1073741824,  # Max uncompressed bundle size
+    "server_file_root": None,  # Path mode reads below this root, None := off
     "hash_sizes-dev": [8]
 }
 
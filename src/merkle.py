@@ -1,21 +1,77 @@
-from pymerkle import BaseMerkleTree, verify_inclusion
+from pymerkle import BaseMerkleTree, MerkleProof, InvalidChallenge
+from concurrent.futures import ThreadPoolExecutor
+from hmac import compare_digest
+from itertools import zip_longest
 import hashlib
+import struct
+from profiler import profiler
+
+TREE_MAGIC = b"PMT1"
+
+# Verification results
+PROOF_VALID = "valid"
+PROOF_BASE_MISMATCH = "base_mismatch"  # Leaf is not the first path entry
+PROOF_ROOT_MISMATCH = "root_mismatch"  # Path does not resolve to the root
+PROOF_MALFORMED = "malformed"  # Invalid rule bits or empty path
+PROOF_OUT_OF_RANGE = "out_of_range"  # Leaf index or size outside the tree
 
 
 def sha256(data):
     return hashlib.sha256(data).digest()
 
 
+def sha256_file(path: str, chunk_size=1 << 20) -> bytes:
+    """
+    Streams a file through sha256 with a bounded buffer
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+        profiler.count("merkle.bytes_read", f.tell())
+    return h.digest()
+
+
+def read_file_hashed(path: str, keep=True, chunk_size=1 << 20):
+    """
+    Reads a file once, returns its sha256 and (if keep) its content
+    """
+    h = hashlib.sha256()
+    chunks = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+            if keep:
+                chunks.append(chunk)
+    return h.digest(), b"".join(chunks) if keep else None
+
+
+def hash_files(files: list, workers=8, chunk_size=1 << 20) -> list:
+    """
+    sha256 of many files in order, hashed on a thread pool
+    (hashlib releases the GIL on large buffers)
+    """
+    profiler.count("merkle.files_hashed", files.__len__())
+    if workers is None or workers <= 1 or files.__len__() < 2:
+        return [sha256_file(f, chunk_size) for f in files]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda f: sha256_file(f, chunk_size), files))
+
+
 class pMerkleTree(BaseMerkleTree):
 
     def __init__(self, algorithm='sha256'):
         """
         Storage setup and superclass initialization
         """
-        self.hashes = []
-
         super().__init__(algorithm)
 
+        # Leaf digests stored back to back in one contiguous buffer
+        self.digest_size = self.hashfunc().digest_size
+        self.hashes = bytearray()
+        # Digests of complete, aligned subtrees per level (levels[0] := leaves)
+        self.levels = [self.hashes]
+
     def _encode_entry(self, data):
         """
         Prepares data entry for hashing
@@ -26,15 +82,17 @@ class pMerkleTree(BaseMerkleTree):
         """
         Stores data hash in a new leaf and returns index
         """
-        self.hashes += [digest]
+        self.hashes += digest
+        self.build_levels()
 
-        return len(self.hashes)
+        return self._get_size()
 
     def _get_leaf(self, index):
         """
         Returns the hash stored by the leaf specified
         """
-        value = self.hashes[index - 1]
+        ds = self.digest_size
+        value = bytes(self.hashes[(index - 1) * ds:index * ds])
 
         return value
 
@@ -42,7 +100,9 @@ class pMerkleTree(BaseMerkleTree):
         """
         Returns hashes corresponding to the specified leaf range
         """
-        values = self.hashes[offset: offset + width]
+        ds = self.digest_size
+        buffer = self.hashes[offset * ds:(offset + width) * ds]
+        values = [bytes(buffer[i:i + ds]) for i in range(0, len(buffer), ds)]
 
         return values
 
@@ -50,22 +110,245 @@ class pMerkleTree(BaseMerkleTree):
         """
         Returns the current number of leaves
         """
-        return len(self.hashes)
+        return len(self.hashes) // self.digest_size
+
+    def _get_subroot_uncached(self, offset, width):
+        """
+        Subroot of a power of two leaf range, hashed level by level over
+        contiguous buffers instead of a deque of leaf objects
+        """
+        ds = self.digest_size
+        level = bytes(self.hashes[offset * ds:(offset + width) * ds])
+        hashfunc = self.hashfunc
+        prefx01 = self.prefx01
+        while width > 1:
+            parents = bytearray()
+            for i in range(0, width * ds, 2 * ds):
+                parents += hashfunc(prefx01 + level[i:i + 2 * ds]).digest()
+            level = parents
+            width >>= 1
+
+        return bytes(level)
+
+    def append_entries(self, entries: list) -> int:
+        """
+        Appends many leaves at once, returns the new size
+        """
+        for data in entries:
+            self.hashes += self._hash_entry(self._encode_entry(data))
+        self.build_levels()
+
+        return self._get_size()
+
+    def _get_subroot(self, offset, width):
+        """
+        Subroot lookup in the level store, falls back to hashing
+        """
+        level = width.bit_length() - 1
+        if level < len(self.levels):
+            ds = self.digest_size
+            start = (offset >> level) * ds
+            node = self.levels[level][start:start + ds]
+            if len(node) == ds:
+                return bytes(node)
+
+        return super()._get_subroot(offset, width)
+
+    def build_levels(self):
+        """
+        Extends the level store to every complete subtree. Complete subtrees
+        never change on append, so existing entries stay valid and an append
+        only hashes the O(log n) new parents.
+        """
+        ds = self.digest_size
+        hashfunc = self.hashfunc
+        prefx01 = self.prefx01
+        level = 0
+        while len(self.levels[level]) >= 2 * ds:
+            if level + 1 == len(self.levels):
+                self.levels.append(bytearray())
+            children = self.levels[level]
+            parents = self.levels[level + 1]
+            for i in range(len(parents) * 2 * ds,
+                           len(children) - 2 * ds + 1, 2 * ds):
+                parents += hashfunc(prefx01 + children[i:i + 2 * ds]).digest()
+            level += 1
+
+    def save(self, path: str):
+        """
+        Writes the level store (leaves and all complete subtrees)
+        """
+        with open(path, "wb") as f:
+            f.write(TREE_MAGIC)
+            f.write(struct.pack("<BI", self.digest_size, len(self.levels)))
+            for level in self.levels:
+                f.write(struct.pack("<Q", len(level)))
+                f.write(level)
+
+    @classmethod
+    def load(cls, path: str, algorithm='sha256') -> "pMerkleTree":
+        tree = cls(algorithm)
+        with open(path, "rb") as f:
+            if f.read(len(TREE_MAGIC)) != TREE_MAGIC:
+                raise ValueError(f"Not a merkle tree file: {path}")
+            digest_size, n_levels = struct.unpack("<BI", f.read(5))
+            if digest_size != tree.digest_size:
+                raise ValueError(f"Digest size mismatch in {path}")
+            levels = []
+            for _ in range(n_levels):
+                (length, ) = struct.unpack("<Q", f.read(8))
+                levels.append(bytearray(f.read(length)))
+
+        tree.hashes = levels[0] if levels.__len__() > 0 else bytearray()
+        tree.levels = [tree.hashes] + levels[1:]
+        tree.build_levels()
+        return tree
 
     def m_get_root(self) -> str:
         return self.get_state().hex()
 
-    def m_proof(self, leaf_index: int, size=None) -> bool:
-        if size == None:
+    def m_proof(self, leaf_index: int, size=None, root=None) -> bool:
+        return self.m_verify(leaf_index, size, root) == PROOF_VALID
+
+    def m_verify(self, leaf_index: int, size=None, root=None) -> str:
+        """
+        Proves and verifies one leaf, returns a PROOF_* result
+        """
+        try:
+            proof = self.prove_inclusion(leaf_index, size)
+        except InvalidChallenge:
+            return PROOF_OUT_OF_RANGE
+
+        if root is None:
+            root = self.get_state(size)
+        return verify_proof(self.get_leaf(leaf_index), root, proof)
+
+    def prove_inclusion_batch(self, indices=None, size=None) -> list:
+        """
+        Inclusion proofs for many leaves (default: all). Inner nodes are
+        computed once into the level store and shared by all proofs.
+        """
+        if size is None:
             size = self.get_size()
+        if indices is None:
+            indices = range(1, size + 1)
 
-        proof = self.prove_inclusion(leaf_index)
-        root = self.get_state()
-        leaf = self.get_leaf(leaf_index)
+        self.build_levels()
+        return [self.prove_inclusion(index, size) for index in indices]
+
+    def verify_batch(self, indices=None, size=None, root=None) -> list:
+        """
+        Proves and verifies many leaves against one root
+
+        :return: List of (leaf_index, PROOF_* result)
+        """
+        if size is None:
+            size = self.get_size()
+        if indices is None:
+            indices = range(1, size + 1)
+        if root is None:
+            root = self.get_state(size)
+
+        indices = list(indices)
+        in_range = [i for i in indices if 0 < i <= size <= self.get_size()]
+        proofs = dict(zip(in_range, self.prove_inclusion_batch(in_range,
+                                                               size)))
+        leaves = [self.get_leaf(i) if i in proofs else None for i in indices]
+        results = verify_proofs(leaves, root,
+                                [proofs.get(i) for i in indices])
+        return list(zip(indices, results))
+
+
+def resolve_proof(proof: MerkleProof, memo=None) -> bytes:
+    """
+    MerkleProof.resolve with an optional memo of hashed node pairs that
+    is shared between proofs of the same tree
+    """
+    if proof.path.__len__() == 0:
+        raise ValueError("Empty path")
+
+    hash_pair = proof.hasher.hash_pair
+    bit, result = proof.rule[0], proof.path[0]
+    for next_bit, digest in zip(proof.rule[1:], proof.path[1:]):
+        if bit == 0:
+            pair = (result, digest)
+        elif bit == 1:
+            pair = (digest, result)
+        else:
+            raise ValueError("Invalid bit found")
+
+        if memo is None:
+            result = hash_pair(*pair)
+        else:
+            result = memo.get(pair)
+            if result is None:
+                result = memo[pair] = hash_pair(*pair)
+        bit = next_bit
+
+    return result
+
+
+def verify_proof(leaf: bytes, root: bytes, proof: MerkleProof,
+                 memo=None) -> str:
+    """
+    Verifies an inclusion proof, returns a PROOF_* result
+    """
+    if proof is None or leaf is None:
+        return PROOF_OUT_OF_RANGE
+    if proof.path.__len__() == 0 or proof.rule.__len__() != proof.path.__len__():
+        return PROOF_MALFORMED
+    if not compare_digest(proof.path[0], leaf):
+        return PROOF_BASE_MISMATCH
+
+    try:
+        resolved = resolve_proof(proof, memo)
+    except ValueError:
+        return PROOF_MALFORMED
+
+    if not compare_digest(resolved, root):
+        return PROOF_ROOT_MISMATCH
+    return PROOF_VALID
+
+
+def verify_proofs(leaves: list, root: bytes, proofs: list) -> list:
+    """
+    Verifies many proofs against one root, sharing hashed node pairs.
+    Leaves without a proof and proofs without a leaf are out of range.
+    """
+    memo: dict = {}
+    return [
+        verify_proof(leaf, root, proof, memo)
+        for leaf, proof in zip_longest(leaves, proofs)
+    ]
+
+
+def serialize_multiproof(proofs: list) -> dict:
+    """
+    Compact form of many proofs of one tree state: every distinct digest
+    is stored once and proofs reference it by position
+    """
+    nodes: dict = {}
+    serialized = []
+    for proof in proofs:
+        serialized.append({
+            "rule": "".join(str(bit) for bit in proof.rule),
+            "path": [nodes.setdefault(d, nodes.__len__()) for d in proof.path]
+        })
+
+    metadata = proofs[0].get_metadata() if proofs.__len__() > 0 else {}
+    return {
+        "metadata": metadata,
+        "nodes": [digest.hex() for digest in nodes],
+        "proofs": serialized
+    }
 
-        try:
-            verify_inclusion(leaf, root, proof)
-        except:
-            return False
 
-        return True
+def deserialize_multiproof(data: dict) -> list:
+    nodes = [bytes.fromhex(digest) for digest in data["nodes"]]
+    return [
+        MerkleProof(**data["metadata"],
+                    rule=[int(bit) for bit in proof["rule"]],
+                    subset=[],
+                    path=[nodes[i] for i in proof["path"]])
+        for proof in data["proofs"]
+    ]
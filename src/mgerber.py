@@ -1,8 +1,16 @@
 from gerber import load_layer
 from gerber.render import RenderSettings
-from gerber.render.cairo_backend import GerberCairoContext
 from glob import glob
 from utils import delete_folder, create_dir
+from merkle import hash_files, sha256
+from bithash import pBitHash, threshold_to_distance
+from phash_ctrl import pHashBaseController, phash_batch
+from mconfig import config
+from PIL import Image
+from io import BytesIO
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
 import os
 from collections import namedtuple
 
@@ -18,6 +26,7 @@ from collections import namedtuple
 # Config
 is_rnd_solder_layer = False
 clean_before_run = True
+render_workers = None  # Process pool size, None -> cpu count
 rnd = namedtuple('Colors', ['transparent', 'white', 'black', 'red', 'green'])
 Colors = rnd(transparent=RenderSettings((0, 0, 0), alpha=0),
              white=RenderSettings((1, 1, 1)),
@@ -45,6 +54,171 @@ def color_for_layer2(idx: int, layers: int):
     return RenderSettings((c, c, c), alpha=1)
 
 
+# A board render: output png, scale and (gerber, bgsettings, settings) layers
+RenderJob = namedtuple('RenderJob', ['out_path', 'scale', 'layers'])
+
+
+def settings_to_tuple(settings: RenderSettings) -> tuple:
+    return (tuple(settings.color), settings.alpha, settings.invert,
+            settings.mirror)
+
+
+def load_layers(job: RenderJob) -> list:
+    """
+    Parsed layers of a board, once per job
+    """
+    return [load_layer(path) for path, _, _ in job.layers]
+
+
+def get_render_key(job: RenderJob, digests: dict) -> str:
+    """
+    Digest of the gerber contents plus every render setting of a board
+    """
+    return sha256(
+        json.dumps({
+            "scale":
+            job.scale,
+            "layers": [(digests[path].hex(), settings_to_tuple(bg),
+                        settings_to_tuple(fg)) for path, bg, fg in job.layers]
+        }).encode()).hex()
+
+
+def draw_board(job: RenderJob, layers: list, scale=None):
+    from gerber.render.cairo_backend import GerberCairoContext  # libcairo
+    ctx = GerberCairoContext(scale or job.scale)
+    for layer, (_, bg, fg) in zip(layers, job.layers):
+        ctx.render_layer(layer, bgsettings=bg, settings=fg)
+    return ctx
+
+
+def render_board(job: RenderJob) -> str:
+    ctx = draw_board(job, load_layers(job))
+    create_dir(os.path.dirname(job.out_path))
+    ctx.dump(job.out_path)
+    ctx.clear()
+    return job.out_path
+
+
+def get_hash_scale(job: RenderJob, layers: list, hash_size: int,
+                   oversample: float) -> float:
+    """
+    Scale at which the longer board side spans oversample times the
+    pHash input size (hash_size * high_freq_factor)
+    """
+    extent = 0.0
+    for layer in layers:
+        (x0, x1), (y0, y1) = layer.bounds
+        extent = max(extent, abs(x1 - x0), abs(y1 - y0))
+    if extent == 0:
+        raise ValueError(f"Layers of {job.out_path} have no extent")
+    return hash_size * config["high_freq_factor"] * oversample / extent
+
+
+def render_board_pixels(job: RenderJob, hash_size: int,
+                        oversample: float) -> np.ndarray:
+    """
+    pHash input pixels of a board rendered to a small in-memory raster
+    """
+    layers = load_layers(job)
+    ctx = draw_board(job, layers,
+                     get_hash_scale(job, layers, hash_size, oversample))
+    image = Image.open(BytesIO(ctx.dump_str()))
+    ctx.clear()
+    return pHashBaseController(hash_size).get_phash_pixels(image)
+
+
+def hash_boards(jobs: list, hash_size: int, oversample=None,
+                workers=None) -> list:
+    """
+    pHashes straight from the gerbers without writing the full scale png
+
+    :return: pBitHash per job
+    """
+    oversample = oversample or config["gerber_hash_oversample"]
+    with ProcessPoolExecutor(max_workers=workers or render_workers) as executor:
+        futures = [
+            executor.submit(render_board_pixels, job, hash_size, oversample)
+            for job in jobs
+        ]
+        pixels = [future.result() for future in futures]
+    if pixels.__len__() == 0:
+        return []
+    packed = phash_batch(np.stack(pixels), hash_size)
+    return [pBitHash(row, hash_size * hash_size) for row in packed]
+
+
+def check_hash_tolerance(jobs: list,
+                         state_path: str,
+                         hash_size: int,
+                         tolerance=None,
+                         oversample=None) -> list:
+    """
+    Compares the direct pHashes against the ones of the rendered pngs
+
+    :param tolerance: Min normalized similarity, see gerber_hash_tolerance
+    :return: Rows of (out_path, hamming, similarity, ok)
+    """
+    tolerance = tolerance or config["gerber_hash_tolerance"]
+    max_distance = threshold_to_distance(tolerance, hash_size * hash_size)
+    render_boards(jobs, state_path)
+    direct = hash_boards(jobs, hash_size, oversample)
+
+    ctrl = pHashBaseController(hash_size)
+    rows = []
+    for job, d_hash in zip(jobs, direct):
+        with Image.open(job.out_path) as img:
+            pixels = ctrl.get_phash_pixels(img)
+        p_hash = pBitHash(phash_batch(pixels, hash_size)[0],
+                          hash_size * hash_size)
+        ham = d_hash.hamming(p_hash)
+        rows.append((job.out_path, ham, d_hash.similarity(p_hash),
+                     ham <= max_distance))
+    failed = [row for row in rows if not row[3]]
+    print(f"Direct vs. png pHash ({hash_size}): {failed.__len__()} of "
+          f"{rows.__len__()} boards outside tolerance {tolerance}")
+    return rows
+
+
+def render_boards(jobs: list, state_path: str, workers=None) -> list:
+    """
+    Renders boards on a process pool, boards whose png exists and whose
+    render key matches the one stored in state_path are skipped
+
+    :return: Output paths that were rendered
+    """
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    paths = sorted({path for job in jobs for path, _, _ in job.layers})
+    digests = dict(zip(paths, hash_files(paths)))
+    keys = [get_render_key(job, digests) for job in jobs]
+    todo = [(job, key) for job, key in zip(jobs, keys)
+            if state.get(job.out_path) != key
+            or not os.path.exists(job.out_path)]
+    print(f"Boards to render: {todo.__len__()} "
+          f"({jobs.__len__() - todo.__len__()} up to date)")
+
+    rendered = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers or render_workers) as executor:
+            futures = {
+                executor.submit(render_board, job): key
+                for job, key in todo
+            }
+            for future in as_completed(futures):
+                out_path = future.result()
+                state[out_path] = futures[future]
+                rendered.append(out_path)
+                print(f"{(rendered.__len__() / todo.__len__()):.0%}")
+    finally:
+        create_dir(os.path.dirname(state_path) or ".")
+        with open(state_path, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+    return rendered
+
+
 def check_dir(module: str):
     OUTPUT = f"./assets/output/gerber/{module}"
     if clean_before_run:
@@ -60,60 +234,61 @@ def layers_only():
     module = "default3"
     gerber_folders = check_dir(module)
 
+    out_path_fl = f"./assets/output/gerber/{module}"
+    jobs = []
     for gerber_folder in gerber_folders:
-        ctx = GerberCairoContext(scale=50)
         folder_name = get_folder_name(gerber_folder)
         top_copper = glob(f"{gerber_folder}/copper_top.gbr").pop()
         bottom_copper = glob(f"{gerber_folder}/copper_bottom.gbr").pop()
-        out_path_fl = f"./assets/output/gerber/{module}"
-        create_dir(out_path_fl)
-
-        bottom_copper_layer = load_layer(bottom_copper)
-        top_copper_layer = load_layer(top_copper)
+        jobs.append(
+            RenderJob(f"{out_path_fl}/{folder_name}.png", 50, [
+                (bottom_copper, Colors.transparent, color_for_layer2(1, 2)),
+                (top_copper, Colors.transparent, color_for_layer2(2, 2)),
+            ]))
+    render_boards(jobs, f"{out_path_fl}/.render-state.json")
 
-        ctx.render_layer(bottom_copper_layer,
-                         bgsettings=Colors.transparent,
-                         settings=color_for_layer2(1, 2))
-        ctx.render_layer(top_copper_layer,
-                         bgsettings=Colors.transparent,
-                         settings=color_for_layer2(2, 2))
 
-        top_file_path = f"{out_path_fl}/{folder_name}.png"
-        ctx.dump(top_file_path)
-        ctx.clear()
+def get_single_gerber_jobs(module: str) -> list:
+    GERBER_FOLDER = f"./assets/original/gerbers/{module}/*"
+    OUTPUT = f"./assets/output/gerber/{module}"
+    jobs = []
+    for gerber_folder in sorted(glob(GERBER_FOLDER)):
+        folder_name = get_folder_name(gerber_folder)
+        top_copper = glob(f"{gerber_folder}/*.GTL").pop()
+        bottom_copper = glob(f"{gerber_folder}/*.GBL").pop()
+        #top_copper = glob(f"{gerber_folder}/copper_top.gbr").pop()
+        #bottom_copper = glob(f"{gerber_folder}/copper_bottom.gbr").pop()
+        jobs.append(
+            RenderJob(f"{OUTPUT}/{folder_name}.png", 1000, [
+                (top_copper, Colors.black, color_for_layer(1, 2)),
+                (bottom_copper, Colors.transparent, color_for_layer(2, 2)),
+            ]))
+    return jobs
 
 
 def single_gerbers():
     MODULE = "default2"
-    GERBER_FOLDER = f"./assets/original/gerbers/{MODULE}/*"
     OUTPUT = f"./assets/output/gerber/{MODULE}"
     create_dir(OUTPUT)
-    gerber_folders = glob(GERBER_FOLDER)
-    for idx, gerber_folder in enumerate(gerber_folders):
-        ctx = GerberCairoContext(1000)
-        folder_name = get_folder_name(gerber_folder)
-        print(f"{(idx / gerber_folders.__len__()):.0%}")
+    render_boards(get_single_gerber_jobs(MODULE), f"{OUTPUT}/.render-state.json")
 
-        top_copper = glob(f"{gerber_folder}/*.GTL").pop()
-        bottom_copper = glob(f"{gerber_folder}/*.GBL").pop()
-        #top_copper = glob(f"{gerber_folder}/copper_top.gbr").pop()
-        #bottom_copper = glob(f"{gerber_folder}/copper_bottom.gbr").pop()
 
-        top = load_layer(top_copper)
-        bottom = load_layer(bottom_copper)
+def single_gerbers_hashes(hash_size: int) -> dict:
+    """
+    Direct gerber-to-hash variant of single_gerbers, no pngs written
+    """
+    jobs = get_single_gerber_jobs("default2")
+    return {
+        os.path.basename(job.out_path): h
+        for job, h in zip(jobs, hash_boards(jobs, hash_size))
+    }
 
-        ctx.render_layer(top,
-                         bgsettings=Colors.black,
-                         settings=color_for_layer(1, 2))
-        #ctx.render_layer(bottom, bgsettings=Colors.transparent, settings=color_for_layer(1, 2))
-        ctx.render_layer(bottom,
-                         bgsettings=Colors.transparent,
-                         settings=color_for_layer(2, 2))
-        #ctx.render_layer(bottom, bgsettings=Colors.transparent, settings=Colors.green)
 
-        file_path = f"{OUTPUT}/{folder_name}.png"
-        ctx.dump(file_path)
-        ctx.clear()
+def check_single_gerbers_hashes(hash_size: int) -> list:
+    MODULE = "default2"
+    OUTPUT = f"./assets/output/gerber/{MODULE}"
+    return check_hash_tolerance(get_single_gerber_jobs(MODULE),
+                                f"{OUTPUT}/.render-state.json", hash_size)
 
 
 # Gerbers for line width structure
@@ -124,33 +299,20 @@ def gen_mpls_line_only():
     create_dir(OUTPUT)
     gerber_folders = glob(GERBER_FOLDER)
 
+    jobs = []
     for gerber_folder2 in gerber_folders:
         folder_name = get_folder_name(gerber_folder2)
-        print("####################################")
-        print("Folder:", folder_name)
-        print("####################################")
         for gerber_folder in glob(f"{gerber_folder2}/*"):
-            ctx = GerberCairoContext(100)
             mod_type = get_folder_name(gerber_folder)
-
             top_copper = glob(f"{gerber_folder}/copper_top.gbr").pop()
             bottom_copper = glob(f"{gerber_folder}/copper_bottom.gbr").pop()
-
-            top = load_layer(top_copper)
-            bottom = load_layer(bottom_copper)
-
-            ctx.render_layer(bottom,
-                             bgsettings=Colors.transparent,
-                             settings=color_for_layer2(1, 2))
-            ctx.render_layer(top,
-                             bgsettings=Colors.transparent,
-                             settings=color_for_layer2(2, 2))
-
             out_path = f"{OUTPUT}/{folder_name}"
-            create_dir(out_path)
-            file_path = f"{out_path}/{mod_type}-{folder_name}.png"
-            ctx.dump(file_path)
-            ctx.clear()
+            jobs.append(
+                RenderJob(f"{out_path}/{mod_type}-{folder_name}.png", 100, [
+                    (bottom_copper, Colors.transparent, color_for_layer2(1, 2)),
+                    (top_copper, Colors.transparent, color_for_layer2(2, 2)),
+                ]))
+    render_boards(jobs, f"{OUTPUT}/.render-state.json")
 
 
 #gen_mpls_line_only()
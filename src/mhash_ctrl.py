@@ -1,10 +1,23 @@
-from glob import glob
+from fnmatch import fnmatch
 import pandas as pd
 import os
+from io import BytesIO
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 from phash_ctrl import pHashController
 from image_ctrl import pImageController
 from utils import count_valid_rows
-from merkle import pMerkleTree, sha256
+from pymerkle import MerkleProof, InvalidProof, verify_consistency
+from merkle import pMerkleTree, hash_files, read_file_hashed, serialize_multiproof, deserialize_multiproof, verify_proofs
+from bithash import pack_hashes, lower_triangle_pairs, threshold_to_distance
+from hash_cache import get_hash_cache
+from hash_index import pHashIndex, get_index_path
+from hash_store import open_store
+from catalog import get_catalog
+from report_sink import get_report_sink
+from profiler import profiler, profiled
+import numpy as np
 import utils
 import json
 from mconfig import config
@@ -19,23 +32,33 @@ class MultiHashController:
         self.img_ctrl = img_ctrl
         self.config = config
         utils.create_dir(self.output_path)
+        self.report_sink = get_report_sink(self.output_path)
 
+    @profiled("mhash.create_mhash_average_sheet")
     def create_mhash_average_sheet(self,
                                    input_folder: str,
                                    ave_selector: str,
                                    target_selector: str,
                                    image_set_type: str,
-                                   include_ave=True) -> pd.DataFrame:
-        folders = glob(self.img_ctrl.get_output_path(input_folder),
-                       recursive=True)
+                                   include_ave=True,
+                                   variant_sets=None) -> pd.DataFrame:
+        """
+        :param variant_sets: Optional iterable of (folder, [(path, image)])
+                             from pImageController.stream_*, the variants
+                             are hashed in memory instead of read from disk
+        """
+        if variant_sets is None:
+            variant_sets = [(folder, None) for folder in get_catalog().folders(
+                self.img_ctrl.get_output_path(input_folder))]
         table_data: list = []
         row_selector = target_selector[:-2]
 
         is_versions = input_folder.__contains__("versions")
-        for folder in folders:
-            ave_files = glob(f"{folder}{ave_selector}")
+        for folder, variants in variant_sets:
+            ave_files, ave_images = self.select_files(folder, ave_selector,
+                                                      variants)
             ave_hash_ctrl = pHashController(ave_files, self.config,
-                                            is_versions, True)
+                                            is_versions, True, ave_images)
 
             if include_ave:
                 ave_metadata = self.img_ctrl.get_metadata(
@@ -50,9 +73,11 @@ class MultiHashController:
 
                 table_data.append(ave_df)
 
-            target_files = glob(f"{folder}{target_selector}")
+            target_files, target_images = self.select_files(
+                folder, target_selector, variants)
             target_hash_ctrl = pHashController(target_files, self.config,
-                                               is_versions, False)
+                                               is_versions, False,
+                                               target_images)
             target_metadata = self.img_ctrl.get_metadata(
                 target_files, image_set_type)
 
@@ -89,98 +114,109 @@ class MultiHashController:
 
             hash_len = self.config["hash_size"]
             df.reset_index(drop=True, inplace=True)
-            df.to_excel(
-                f"{self.output_path}/hash-{hash_len}-{input_folder[:-3]}-output.xlsx"
-            )
+            self.report_sink.write(df, "average", input_folder[:-3], hash_len)
+            get_catalog().save()
+            if self.config.get("hash_store") is not None:
+                open_store(self.config["hash_store"], hash_len).append_frame(df)
             return df
         else:
             print("Error: No image data was generated for tables:",
                   input_folder)
         return pd.DataFrame()
 
-    def create_mhash_false_positive_sheet(self, mhashes: pd.DataFrame,
-                                          label: str):
+    def select_files(self, folder: str, selector: str, variants=None):
+        """
+            Files (and in-memory images) of a folder matching a selector
         """
-        Compares the ave hash of every image-set with all other normal images for false positives        
+        if variants is None:
+            return get_catalog().files(folder, selector), None
+        selected = [(path, img) for path, img in variants
+                    if fnmatch(os.path.basename(path), selector)]
+        return [path for path, _ in selected], [img for _, img in selected]
+
+    @profiled("mhash.create_mhash_false_positive_sheet")
+    def create_mhash_false_positive_sheet(self,
+                                          mhashes: pd.DataFrame,
+                                          label: str,
+                                          only_valid=None):
         """
-        table_data = []
+        Compares the ave hash of every image-set with all other normal images for false positives
+
+        :param only_valid: Only write pairs above ave_threshold, defaults to
+                           config["fpos_only_valid"]
+        """
+        if only_valid is None:
+            only_valid = self.config.get("fpos_only_valid", False)
 
-        # print(mhashes.__getitem__("ave-hash"))
         subset_na = mhashes[mhashes["value"] == "na"]
         fpos_threshold = self.config["ave_threshold"]
-
-        idx_a = 0
-        for _, rowA in subset_na.iterrows():
-            idx_b = 0
-            ave_a = str(rowA.get("ave-hash"))
-            name_a = str(rowA.get("name"))
-            module_a = str(rowA.get("module"))
-
-            for _, rowB in subset_na.iterrows():
-                if idx_b > idx_a:
-                    continue
-
-                name_b = str(rowB.get("name"))
-                module_b = str(rowB.get("module"))
-
-                if name_a != name_b and module_a != module_b:
-                    ave_b = str(rowB.get("ave-hash"))
-
-                    hamming, normalized = utils.get_phash_distance(
-                        ave_a, ave_b)
-                    new_row = [
-                        ave_a, ave_b, name_a, name_b, hamming, normalized,
-                        normalized >= fpos_threshold
-                    ]
-                    table_data.append(new_row)
-                idx_b += 1
-            idx_a += 1
-
-        df = pd.DataFrame(table_data,
-                          columns=[
-                              'phash_a', 'phash_b', 'name_a', 'name_b', 'ham',
-                              'norm', "valid"
-                          ])
+        ave_hashes = subset_na["ave-hash"].astype(str).to_numpy()
+        names = subset_na["name"].astype(str).to_numpy()
+        modules = subset_na["module"].astype(str).to_numpy()
+
+        ave_bits = pack_hashes(list(ave_hashes))
+        bit_len = ave_bits.shape[1] * 8
+        max_distance = threshold_to_distance(fpos_threshold, bit_len)
+
+        idx_a, idx_b, hamming = [np.empty(0, dtype=np.int64)] * 3
+        n = ave_bits.shape[0]
+        profiler.count("fpos.pairs_compared", n * (n - 1) // 2)
+        if ave_bits.shape[0] > 0:
+            blocks = list(
+                lower_triangle_pairs(
+                    ave_bits,
+                    block_size=self.config.get("fpos_block_size", 512),
+                    max_distance=max_distance if only_valid else None,
+                    distinct=(pd.factorize(names)[0],
+                              pd.factorize(modules)[0])))
+            if blocks.__len__() > 0:
+                idx_a, idx_b, hamming = [np.concatenate(c) for c in zip(*blocks)]
+
+        df = pd.DataFrame({
+            'phash_a': ave_hashes[idx_a],
+            'phash_b': ave_hashes[idx_b],
+            'name_a': names[idx_a],
+            'name_b': names[idx_b],
+            'ham': hamming,
+            'norm': 1.0 - hamming / bit_len,
+            "valid": hamming <= max_distance
+        })
         hash_len = self.config["hash_size"]
         df.sort_values(by=['norm', 'name_a'], inplace=True, ascending=False)
-        df.to_excel(
-            f"{self.output_path}/hash-{hash_len}-{label}-fpos-output.xlsx")
+        self.report_sink.write(df, "fpos", label, hash_len)
 
         fpos_valid = count_valid_rows(df, "valid")
         print(
             f"NumOf false positives (res-na x res-na images): {fpos_valid:.2%} for < {fpos_threshold:.0%}"
         )
+        return df
 
-        # print(df.drop(columns=['phash_a', 'phash_b']))
-
+    @profiled("mhash.create_mpls_sheet")
     def create_mpls_sheet(self):
         hash_len = self.config["hash_size"]
         phash_ctrl = pHashController([], self.config, False, False)
         p = "./assets/original/mpls/"
 
-        df_ele = phash_ctrl.get_manual_mpls(glob(f"{p}elements/*"), "elements")
+        catalog = get_catalog()
+        df_ele = phash_ctrl.get_manual_mpls(catalog.folders(f"{p}elements/*/"),
+                                            "elements")
         df_ele.sort_values(by=['name', 'norm'], inplace=True, ascending=False)
         #df_ele = self.group_element_sheet(df_ele)
-        df_ele.to_excel(
-            f"{self.output_path}/hash-{hash_len}-mpl_elements-output.xlsx")
+        self.report_sink.write(df_ele, "mpls", "mpl_elements", hash_len)
 
-        df_lw = phash_ctrl.get_manual_mpls(glob(f"{p}conduct_width_2/*/"),
+        df_lw = phash_ctrl.get_manual_mpls(catalog.folders(f"{p}conduct_width_2/*/"),
                                            "conduct_width")
         df_lw.sort_values(by=['name'], inplace=True, ascending=False)
-        df_lw.to_excel(
-            f"{self.output_path}/hash-{hash_len}-mpl_conduct_width-output.xlsx"
-        )
+        self.report_sink.write(df_lw, "mpls", "mpl_conduct_width", hash_len)
 
-        df_cl = phash_ctrl.get_manual_mpls(glob(f"{p}conduct_layout/*"),
+        df_cl = phash_ctrl.get_manual_mpls(catalog.folders(f"{p}conduct_layout/*/"),
                                            "conduct_layout")
-        df_cl.to_excel(
-            f"{self.output_path}/hash-{hash_len}-mpl_conduct_layout-output.xlsx"
-        )
+        self.report_sink.write(df_cl, "mpls", "mpl_conduct_layout", hash_len)
 
-        df_cl = phash_ctrl.get_manual_mpls(glob(f"{p}wire_only_mpls/*"),
+        df_cl = phash_ctrl.get_manual_mpls(catalog.folders(f"{p}wire_only_mpls/*/"),
                                            "wire_only_mpls")
-        df_cl.to_excel(
-            f"{self.output_path}/hash-{hash_len}-wire_only_mpls-output.xlsx")
+        self.report_sink.write(df_cl, "mpls", "wire_only_mpls", hash_len)
+        catalog.save()
 
     def group_element_sheet(self, df: pd.DataFrame):
         mpls_1 = []
@@ -212,19 +248,120 @@ class MultiHashController:
 
         return new_df
 
+    def get_aph_index(self) -> pHashIndex:
+        """
+            Persistent APH index of all registered assets for this hash_size
+        """
+        if getattr(self, "aph_index", None) is None:
+            self.aph_index = pHashIndex.open(self.config["aph_index_path"],
+                                             self.config["hash_size"])
+        return self.aph_index
+
+    def find_similar_assets(self, average_phash: str,
+                            is_version_set=False) -> list:
+        """
+            Registered assets with an APH above the (versions) ave_threshold
+        """
+        threshold = self.config[
+            "ave_threshold_versions" if is_version_set else "ave_threshold"]
+        return self.get_aph_index().query_threshold(average_phash, threshold)
+
+    def register_asset(self, asset_id: str, average_phash: str, save=True):
+        index = self.get_aph_index()
+        index.insert(asset_id, average_phash)
+        if save:
+            index.save(
+                get_index_path(self.config["aph_index_path"],
+                               self.config["hash_size"]))
+
+    @profiled("mhash.create_tree")
     def create_tree(self, files):
         """
             Generate cryptographic sha256 hashes
         """
-        c_hashes = []
         self.tree = pMerkleTree()
+        self.tree_files = []
+        self.tree.append_entries(self.get_file_digests(files))
+        self.tree_files = [os.path.basename(f) for f in files]
+
+    def get_file_digests(self, files: list) -> list:
+        cache = get_hash_cache()
+        if cache is not None:
+            return cache.file_digests(files)
+        return hash_files(files, self.config.get("merkle_workers", 8),
+                          self.config.get("merkle_chunk_size", 1 << 20))
+
+    def get_tree_path(self, asset_dir: str) -> str:
+        return os.path.join(asset_dir, ".merkle")
 
-        for filename in files:
-            with open(filename, "rb") as f:
-                bytes = f.read()
-                readable_hash = sha256(bytes)
-                c_hashes.append(readable_hash)
-                self.tree.append_entry(readable_hash)
+    def open_tree(self, asset_dir: str):
+        """
+            Loads the persisted tree of an asset (or starts an empty one)
+        """
+        path = self.get_tree_path(asset_dir)
+        if os.path.exists(path):
+            self.tree = pMerkleTree.load(path)
+            with open(f"{path}.json") as f:
+                self.tree_files = json.load(f)["files"]
+        else:
+            self.tree = pMerkleTree()
+            self.tree_files = []
+        return self.tree
+
+    def save_tree(self, asset_dir: str):
+        path = self.get_tree_path(asset_dir)
+        self.tree.save(path)
+        with open(f"{path}.json", "w") as f:
+            json.dump({"files": self.tree_files}, f)
+
+    def append_files(self, asset_dir: str, files: list) -> str:
+        """
+            Appends new file versions to an asset's persisted tree, only the
+            new files are hashed. Returns the new merkle root.
+        """
+        self.open_tree(asset_dir)
+        self.tree.append_entries(self.get_file_digests(files))
+        self.tree_files += [os.path.basename(f) for f in files]
+        self.save_tree(asset_dir)
+        return self.get_merkle_root()
+
+    def prove_consistency(self, old_size: int) -> dict:
+        """
+            Proof that the root of the first old_size files is a prefix of
+            the current tree
+        """
+        return self.tree.prove_consistency(old_size).serialize()
+
+    def verify_consistency(self, old_root: str, new_root: str,
+                           proof: dict) -> bool:
+        try:
+            verify_consistency(bytes.fromhex(old_root), bytes.fromhex(new_root),
+                               MerkleProof.deserialize(proof))
+        except InvalidProof:
+            return False
+        return True
+
+    def prove_files(self) -> dict:
+        """
+            Serialized inclusion proofs for all files of the current tree
+        """
+        return serialize_multiproof(self.tree.prove_inclusion_batch())
+
+    def verify_files(self, files: list, merkle_root: str,
+                     multiproof: dict) -> list:
+        """
+            Verifies files (in tree order) against a token's merkle root and
+            the proofs from prove_files
+
+            :return: List of (file, PROOF_* result), files without a proof
+                     and proofs without a file (None) are out of range
+        """
+        proofs = deserialize_multiproof(multiproof)
+        digests = self.get_file_digests(files)
+        hasher = pMerkleTree()
+        leaves = [hasher.hash_buff(digest) for digest in digests]
+        results = verify_proofs(leaves, bytes.fromhex(merkle_root), proofs)
+        return list(zip_longest(files, results))
 
     def get_merkle_root(self) -> str:
         merkle_root = self.tree.m_get_root()
@@ -232,10 +369,78 @@ class MultiHashController:
         # print("is_proof_valid:", is_proof_valid)
         return merkle_root
 
+    def get_token_data(self, average_phash: str) -> dict:
+        return {
+            "merkle_root": self.get_merkle_root(),
+            "average_phash:": average_phash
+        }
+
     def toJson(self, average_phash: str, indent=0):
-        return json.dumps(
-            {
-                "merkle_root": self.get_merkle_root(),
-                "average_phash:": average_phash
-            },
-            indent=indent)
+        return json.dumps(self.get_token_data(average_phash), indent=indent)
+
+    def decode_images(self, names: list, datas: list):
+        """
+            In-memory images of the decodable (name, bytes) pairs, data of
+            None marks a file that is not read as an image
+        """
+        image_names = []
+        images = []
+        for name, data in zip(names, datas):
+            if data is None:
+                continue
+            try:
+                img = Image.open(BytesIO(data))
+                img.load()
+            except Exception:
+                continue  # Not a decodable image, merkle leaf only
+            image_names.append(name)
+            images.append(img)
+        return image_names, images
+
+    def get_manifest(self, files: list, digests: list, phashes: dict,
+                     average_phash: str) -> dict:
+        """
+            Token manifest of already hashed files, sets the tree
+        """
+        self.tree = pMerkleTree()
+        self.tree.append_entries(digests)
+        self.tree_files = [os.path.basename(f) for f in files]
+
+        manifest = self.get_token_data(average_phash)
+        manifest["hash_size"] = self.config["hash_size"]
+        manifest["files"] = [{
+            "name": os.path.basename(file),
+            "leaf_index": idx + 1,
+            "sha256": digest.hex(),
+            "phash": phashes.get(file)
+        } for idx, (file, digest) in enumerate(zip(files, digests))]
+        return manifest
+
+    @profiled("mhash.ingest_asset")
+    def ingest_asset(self, files: list, is_version_set=False, indent=0) -> str:
+        """
+            Token manifest from a single read per file: the bytes feed both
+            the sha256 merkle leaves and the image decode for the APH
+        """
+        image_extensions = Image.registered_extensions()
+        read = lambda file: read_file_hashed(
+            file,
+            os.path.splitext(file)[1].lower() in image_extensions,
+            self.config.get("merkle_chunk_size", 1 << 20))
+        with ThreadPoolExecutor(
+                max_workers=self.config.get("merkle_workers", 8)) as executor:
+            results = list(executor.map(read, files))
+
+        image_files, images = self.decode_images(
+            files, [data for _, data in results])
+        phashes = {}
+        average_phash = None
+        if image_files.__len__() > 0:
+            phash_ctrl = pHashController(image_files, self.config,
+                                         is_version_set, True, images)
+            phashes = dict(zip(image_files, map(str, phash_ctrl.phashes)))
+            average_phash = phash_ctrl.average_phash
+
+        manifest = self.get_manifest(files, [digest for digest, _ in results],
+                                     phashes, average_phash)
+        return json.dumps(manifest, indent=indent)
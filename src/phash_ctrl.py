@@ -5,16 +5,76 @@ import imagehash
 import pandas as pd
 import utils
 import os
-from glob import glob
+from bithash import pBitHash, pAverageHash, pack_hashes, distance_matrix
+from hash_cache import get_hash_cache, get_phash_params
 import scipy.fftpack
 from mconfig import config
-from math import floor
+from contextlib import nullcontext
+from profiler import profiler, profiled
+from catalog import get_catalog
+
+
+def phash_batch(pixels: np.ndarray, hash_size: int) -> np.ndarray:
+    """
+    Vectorized pHash over a stack of resized grayscale images
+
+    :param pixels: Tensor of shape (N, S, S) with S >= hash_size
+    :param hash_size: Edge length of the low-frequency DCT submatrix
+    :return: Packed bit matrix of shape (N, hash_size**2 / 8) as uint8
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    if pixels.ndim == 2:
+        pixels = pixels[np.newaxis]
+    n = pixels.shape[0]
+
+    # 2D DCT-II of every image in one pass (rows, then columns)
+    axis1 = scipy.fftpack.dct(pixels, axis=1)
+    dct = scipy.fftpack.dct(axis1, axis=2)
+
+    dctlowfreq = dct[:, :hash_size, :hash_size].reshape(n, -1)
+    medians = np.median(dctlowfreq, axis=1, keepdims=True)
+    return np.packbits(dctlowfreq > medians, axis=1)
+
+
+def unpack_phash(packed: np.ndarray, hash_size: int) -> np.ndarray:
+    """
+    Converts a packed bit matrix back to boolean (N, hash_size, hash_size)
+    """
+    packed = np.atleast_2d(packed)
+    bits = np.unpackbits(packed, axis=1, count=hash_size * hash_size)
+    return bits.reshape(-1, hash_size, hash_size).astype(bool)
+
+
+BASELINE_HASHERS = {
+    "dhash": imagehash.dhash,
+    "average_hash": imagehash.average_hash,
+    "whash": imagehash.whash,
+}
+
+
+def compute_baseline_hashes(img: Image.Image, names: list) -> dict:
+    return {name: BASELINE_HASHERS[name](img) for name in names}
+
+
+def pack_baseline(h: imagehash.ImageHash) -> bytes:
+    """
+    Baseline hashes are cached as their matrix shape plus packed bits
+    """
+    rows, cols = h.hash.shape
+    return bytes([rows, cols]) + np.packbits(h.hash).tobytes()
+
+
+def unpack_baseline(value: bytes) -> imagehash.ImageHash:
+    rows, cols = value[0], value[1]
+    bits = np.unpackbits(np.frombuffer(value[2:], dtype=np.uint8),
+                         count=rows * cols)
+    return imagehash.ImageHash(bits.reshape(rows, cols).astype(bool))
 
 
 class pHashBaseController:
 
-    def __init__(self):
-        self.hash_size = config["hash_size"]
+    def __init__(self, hash_size=None):
+        self.hash_size = hash_size or config["hash_size"]
 
     def compare(self, a_path: str, b_path: str):
         a_img = Image.open(a_path)
@@ -38,10 +98,28 @@ class pHashBaseController:
         return diff
 
     def get_phash(self, image: Image.Image):
-        fn = image.filename
+        """
+        Single image pHash, thin wrapper around the batch engine
+        """
+        pixels = self.get_phash_pixels(image)
+        packed = self.get_phash_batch(pixels[np.newaxis])
+        return imagehash.ImageHash(unpack_phash(packed, self.hash_size)[0])
+
+    def get_phash_batch(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Packed pHashes of a (N, S, S) stack of pixels from get_phash_pixels
+        """
+        with profiler.span("phash.dct", images=pixels.shape[0]):
+            return phash_batch(pixels, self.hash_size)
+
+    def get_phash_pixels(self, image: Image.Image, hash_size=None) -> np.ndarray:
+        """
+        Grayscale and resize an image to the (S, S) pHash input
+        """
+        fn = getattr(image, "filename", "")
         image = image.convert('L')
         high_freq_factor = config["high_freq_factor"]
-        hash_img_size = int(self.hash_size * high_freq_factor)
+        hash_img_size = int((hash_size or self.hash_size) * high_freq_factor)
         size = (hash_img_size, hash_img_size)
 
         if config.get("phash_resize_mode") == "fit":
@@ -52,22 +130,12 @@ class pHashBaseController:
             black_square.paste(resized_img)
             image = black_square
 
-            image.save("./assets/output/phash/" + os.path.basename(fn))
+            if fn:  # In-memory images have no file name
+                image.save("./assets/output/phash/" + os.path.basename(fn))
         else:
             image = image.resize(size, Image.Resampling.LANCZOS)
 
-        # phash with FFT
-        pixels = np.asarray(image)
-        axis0 = scipy.fftpack.dct(pixels, axis=0)
-        dct = scipy.fftpack.dct(axis0, axis=1)
-
-        # Extracts a square submatrix from the dct matrix
-        # This submatrix contains the low-frequency DCT coefficients
-        # which are often more important for perceptual hashing.
-        dctlowfreq = dct[:self.hash_size, :self.hash_size]
-
-        binary_array_diff = dctlowfreq > np.median(dctlowfreq)
-        return imagehash.ImageHash(binary_array_diff)
+        return np.asarray(image)
 
     def get_scaled_size(self, h_size, imgW, imgH) -> (int, int):
         if imgW > imgH:
@@ -80,64 +148,265 @@ class pHashBaseController:
             return (s_width, h_size)
 
 
+class pMultiResolutionCache(pHashBaseController):
+    """
+    Decodes every file once and hashes it for all config["hash_sizes"] in
+    the same pass. Per-size controllers then read the packed bits from here.
+    """
+
+    def __init__(self, hash_sizes: list):
+        super().__init__()
+        self.hash_sizes = list(hash_sizes)
+        self.entries: dict = {}
+
+    def get_key(self, file: str) -> tuple:
+        st = os.stat(file)
+        return (os.path.abspath(file), st.st_mtime_ns, st.st_size)
+
+    def get_entries(self, files: list, hash_size: int) -> list:
+        """
+        Cache entries {"bits": {hash_size: packed}, "baseline": {name: hash}}
+        for all files, hashing missing ones for every size at once
+        """
+        if hash_size not in self.hash_sizes:
+            self.hash_sizes.append(hash_size)
+        keys = [self.get_key(file) for file in files]
+        missing = [(file, key) for file, key in zip(files, keys)
+                   if hash_size not in self.entries.get(key, {}).get("bits", {})]
+
+        batch_size = config.get("phash_batch_size", 512)
+        for start in range(0, missing.__len__(), batch_size):
+            chunk = missing[start:start + batch_size]
+            pixels: dict = {hs: [] for hs in self.hash_sizes}
+            for file, key in chunk:
+                with Image.open(file) as img:
+                    img.load()
+                    self.entries[key] = {
+                        "bits": {},
+                        "baseline": compute_baseline_hashes(
+                            img, config.get("baseline_hashes", []))
+                    }
+                    for hs in self.hash_sizes:
+                        pixels[hs].append(self.get_phash_pixels(img, hs))
+
+            for hs in self.hash_sizes:
+                bits = phash_batch(np.stack(pixels[hs]), hs)
+                for (_, key), row in zip(chunk, bits):
+                    self.entries[key]["bits"][hs] = row
+
+        return [self.entries[key] for key in keys]
+
+
+multi_resolution_cache = None
+
+
+def get_multi_resolution_cache() -> pMultiResolutionCache:
+    global multi_resolution_cache
+    if multi_resolution_cache is None:
+        multi_resolution_cache = pMultiResolutionCache(config["hash_sizes"])
+    return multi_resolution_cache
+
+
 class pHashController(pHashBaseController):
     metadata: dict
 
-    def __init__(self, files: list, config: dict, is_version_set: bool,
-                 calc_ave_hash: bool):
+    def __init__(self,
+                 files: list,
+                 config: dict,
+                 is_version_set: bool,
+                 calc_ave_hash: bool,
+                 images=None):
+        """
+        :param images: Optional in-memory PIL images aligned with files,
+                       the files are then not opened
+        """
         super().__init__()
         self.ave_threshold = config[
             "ave_threshold_versions" if is_version_set else "ave_threshold"]
         self.files = files
+        self.images = images
+        self.baselines: dict = {}
+        self.average = None
         if files.__len__() > 0:
             self.phashes = self.create_phash_list()
 
             if calc_ave_hash:
                 self.get_average_hash(self.phashes)
 
+    @profiled("phash.create_phash_list")
     def create_phash_list(self):
         """
-        Generate perceptual hashes
+        Generate perceptual hashes, reusing config["hash_cache"] entries
         """
+        n = self.files.__len__()
+        self.phash_bits = np.zeros((n, (self.hash_size**2 + 7) // 8),
+                                   dtype=np.uint8)
+        # Baseline hashes computed in the same pass, others load lazily
+        names = config.get("baseline_hashes", [])
+        baselines: list = [{} for _ in range(n)]
+        todo = list(range(n))
+
+        cache = get_hash_cache() if self.images is None else None
+        if cache is not None:
+            params = get_phash_params(self.hash_size)
+            digests = [cache.file_digest(file) for file in self.files]
+            cached_bits = cache.get_many(digests, "phash", params)
+            cached_baselines = {
+                name: cache.get_many(digests, name)
+                for name in names
+            }
+            todo = []
+            for idx, bits in enumerate(cached_bits):
+                baseline = {
+                    name: values[idx]
+                    for name, values in cached_baselines.items()
+                }
+                if bits is None or None in baseline.values():
+                    todo.append(idx)
+                    continue
+                self.phash_bits[idx] = np.frombuffer(bits, dtype=np.uint8)
+                baselines[idx] = {
+                    name: unpack_baseline(value)
+                    for name, value in baseline.items()
+                }
+
+        profiler.count("phash.cache_hits", n - todo.__len__())
+        if todo.__len__() > 0:
+            profiler.count("phash.files_hashed", todo.__len__())
+            bits, computed = self.__hash_files(todo, names)
+            self.phash_bits[todo] = bits
+            for idx, baseline in zip(todo, computed):
+                baselines[idx] = baseline
+
+            if cache is not None:
+                todo_digests = [digests[idx] for idx in todo]
+                cache.put_many(todo_digests, "phash", list(bits), params)
+                for name in names:
+                    cache.put_many(
+                        todo_digests, name,
+                        [pack_baseline(baseline[name]) for baseline in computed])
+
+        for name in names:
+            self.baselines[name] = [b[name] for b in baselines]
+
+        self.metadata = {}
+        self.phashes = [
+            imagehash.ImageHash(bits)
+            for bits in unpack_phash(self.phash_bits, self.hash_size)
+        ]
+        return self.phashes
+
+    # average_hash and dhash, hash performs slightly worse in most cases
+    @property
+    def baseline_d_hash(self) -> list:
+        return self.get_baseline_hash_list("dhash")
 
-        self.baseline_a_hash = []
-        self.baseline_d_hash = []
-        self.baseline_w_hash = []
+    @property
+    def baseline_a_hash(self) -> list:
+        return self.get_baseline_hash_list("average_hash")
 
-        self.phashes = []
-        for file in self.files:
-            img = Image.open(file)
-            # average_hash and dhash, hash performs slightly worse in most cases
+    @property
+    def baseline_w_hash(self) -> list:
+        return self.get_baseline_hash_list("whash")
 
-            self.baseline_d_hash.append(imagehash.dhash(img))
-            self.baseline_a_hash.append(imagehash.average_hash(img))
-            self.baseline_w_hash.append(imagehash.whash(img))
+    def get_baseline_hash_list(self, name: str) -> list:
+        """
+        Baseline hashes of all files with a BASELINE_HASHERS algorithm,
+        computed on first access
+        """
+        if name in self.baselines:
+            return self.baselines[name]
 
-            hash = self.get_phash(img)
-            self.phashes.append(hash)
-            self.metadata = {}
+        cache = get_hash_cache() if self.images is None else None
+        if cache is not None:
+            digests = [cache.file_digest(file) for file in self.files]
+            values = cache.get_many(digests, name)
+        else:
+            values = [None] * self.files.__len__()
 
-        return self.phashes
+        hashes = []
+        for idx, value in enumerate(values):
+            if value is not None:
+                hashes.append(unpack_baseline(value))
+                continue
+            with self.open_image(idx) as img:
+                hashes.append(BASELINE_HASHERS[name](img))
 
-    def get_average_hash(self, hash_list: list):
+        if cache is not None:
+            missing = [idx for idx, value in enumerate(values) if value is None]
+            cache.put_many([digests[idx] for idx in missing], name,
+                           [pack_baseline(hashes[idx]) for idx in missing])
+
+        self.baselines[name] = hashes
+        return hashes
+
+    def __hash_files(self, indices: list, names: list):
+        """
+        Packed pHashes and `names` baseline hashes of the files at indices
+        """
+        if config.get("phash_multi_resolution") and self.images is None:
+            entries = get_multi_resolution_cache().get_entries(
+                [self.files[idx] for idx in indices], self.hash_size)
+            bits = np.stack([e["bits"][self.hash_size] for e in entries])
+            return bits, [e["baseline"] for e in entries]
+
+        batch_size = config.get("phash_batch_size", 512)
+        bits_chunks = []
+        baselines = []
+        pixels = []
+        for idx in indices:
+            with profiler.timer("phash.decode_resize"):
+                with self.open_image(idx) as img:
+                    baselines.append(compute_baseline_hashes(img, names))
+                    pixels.append(self.get_phash_pixels(img))
+            if self.images is None:
+                profiler.count("phash.bytes_read",
+                               os.path.getsize(self.files[idx]))
+
+            if pixels.__len__() >= batch_size:
+                bits_chunks.append(self.get_phash_batch(np.stack(pixels)))
+                pixels = []
+
+        if pixels.__len__() > 0:
+            bits_chunks.append(self.get_phash_batch(np.stack(pixels)))
+
+        return np.concatenate(bits_chunks), baselines
+
+    def open_image(self, idx: int):
+        if self.images is not None:
+            return nullcontext(self.images[idx])
+        return Image.open(self.files[idx])
+
+    def get_average_hash(self, hash_list: list, weights=None):
         """
         Takes the average of all bits of all hashes to create a new hash
 
         :param hash_list: List containing all hashes as type ImageHash
+        :param weights: Optional weight per hash
+        """
+        self.average = pAverageHash(self.hash_size * self.hash_size)
+        if hash_list is getattr(self, "phashes", None):
+            self.average.add(self.phash_bits, weights, packed=True)
+        else:
+            self.average.add(np.stack([h.hash for h in hash_list]), weights)
+        return self.__set_average_hash()
+
+    def add_average_hash(self, hash: imagehash.ImageHash, weight=None):
+        """
+        Updates the APH with one more (version) hash without recomputing
         """
-        aph = []
-        for i in range(self.hash_size):
-            byte_list: list = [[] for _ in range(self.hash_size)]
-            for hash_idx in range(hash_list.__len__()):
-                for k in range(self.hash_size):
-                    byte_list[k].append(hash_list[hash_idx].hash[i][k])
-            for k in range(byte_list.__len__()):
-                val = np.median(byte_list[k])
-                byte_list[k] = floor(val)
-            aph.append(byte_list)
-
-        h = imagehash.ImageHash(np.array(aph))
+        if self.average is None:
+            self.average = pAverageHash(self.hash_size * self.hash_size)
+        self.average.add(hash.hash[np.newaxis],
+                         None if weight is None else [weight])
+        return self.__set_average_hash()
+
+    def __set_average_hash(self):
+        bits = self.average.get_bits().reshape(self.hash_size,
+                                               self.hash_size)
+        h = imagehash.ImageHash(bits)
         self.average_phash = str(h)
+        self.average_bits = pBitHash.from_imagehash(h)
         return h
 
     def get_table_data(self, hashes: list, metadata: dict,
@@ -147,19 +416,22 @@ class pHashController(pHashBaseController):
             Folder / Hamming (to ave) / Normalized (to ave) / Manipulator
         """
         table = []
+        bit_len = self.average_bits.bit_len
+        hamming_list = distance_matrix(pack_hashes(hashes),
+                                       self.average_bits.packed)[:, 0]
+        module = folder.split("/")[-2]  # := Folder name for versions
         for idx, hash_binary in enumerate(hashes):
             hash = str(hash_binary)
-            hamming, normalized = utils.get_phash_distance(
-                hash, self.average_phash)
+            hamming = int(hamming_list[idx])
+            normalized = 1.0 - hamming / bit_len
             name = metadata["names"][idx]
-            module = folder.split("/")[-2]  # := Folder name for versions
 
             table.append([
                 name,
                 hash,
                 self.average_phash,
                 hamming,
-                str(hash).__len__(),
+                bit_len,
                 normalized,
                 metadata["modifier"][idx],
                 metadata["value"][idx],
@@ -183,41 +455,35 @@ class pHashController(pHashBaseController):
             Folder / Hamming (to ave) / Normalized (to ave) / Manipulator
         """
         table = []
+        bit_len = self.average_bits.bit_len
+        packed = pack_hashes(hashes)
+        hamming_list = distance_matrix(packed, self.average_bits.packed)[:, 0]
+
+        # Mean similarity of every image to all other images of the set
+        pair_norm = 1.0 - distance_matrix(packed, packed) / bit_len
+        sum_phash_list = (pair_norm.sum(axis=1) - 1.0) / (len(hashes) - 1)
+        module = folder.split("/")[-2]  # := Folder name for versions
 
         for i, hash_binary in enumerate(hashes):
             p_hash_1 = str(hash_binary)
-            hamming, normalized = utils.get_phash_distance(
-                p_hash_1, self.average_phash)
+            hamming = int(hamming_list[i])
+            normalized = 1.0 - hamming / bit_len
 
             name = metadata["names"][i]
-            module = folder.split("/")[-2]  # := Folder name for versions
-            sum_phash = 0
-
-            for k, hash_binary_k in enumerate(hashes):
-                if k == i:
-                    continue  # Skip same image
-
-                p_hash_2 = str(hash_binary_k)
-
-                _, default_hash_norm = utils.get_phash_distance(
-                    p_hash_1, p_hash_2)
-                sum_phash += default_hash_norm
-
-            sum_phash = sum_phash / (len(hashes) - 1)
 
             table.append([
                 name,
                 p_hash_1,
                 self.average_phash,
                 hamming,
-                str(p_hash_1).__len__(),
+                bit_len,
                 metadata["modifier"][i],
                 metadata["value"][i],
                 metadata["image_set_type"][i],
                 module,
                 normalized >= self.ave_threshold,
                 normalized,
-                sum_phash,
+                float(sum_phash_list[i]),
             ])
 
         df = pd.DataFrame(table,
@@ -231,33 +497,30 @@ class pHashController(pHashBaseController):
 
     def get_manual_mpls(self, file_list: list, label: str):
         hash_list = []
+        catalog = get_catalog()
         for mpls_folder in file_list:
-            folders = glob(f"{mpls_folder}/*")
+            folders = catalog.files(mpls_folder)
             na_phash = self.__get_na_phash(folders)
             for file in folders:
-                file_split = file.split("-")
-                mod = file_split[file_split.__len__() - 1][:-4]
-
-                if mod == "na":
-                    continue
-                elif os.path.basename(file_split[0]) == "na":
-                    continue
+                variant = catalog.get_variant(file)
+                mod = variant.suffix
 
-                if mod == "na":
+                if mod == "na" or variant.modifier == "na":
                     continue
                 if label == "elements":
                     name = f"{mod}"
                 elif label == "conduct_width":
-                    layer = file.split("/")[-2].split("_")[0]
-                    name = f"{mod}_{layer}-{os.path.basename(file_split[0])}"
+                    layer = variant.module.split("_")[0]
+                    name = f"{mod}_{layer}-{variant.modifier}"
                 elif label == "conduct_layout":
                     name = os.path.basename(file)[:-4]
                 elif label == "wire_only_mpls":
-                    name = f"{mod}_{os.path.basename(file_split[0])}"
+                    name = f"{mod}_{variant.modifier}"
 
-                img = Image.open(file)
-                phash = str(self.get_phash(img))
-                hamming, normalized = utils.get_phash_distance(phash, na_phash)
+                with Image.open(file) as img:
+                    phash = pBitHash.from_imagehash(self.get_phash(img))
+                hamming = phash.hamming(na_phash)
+                normalized = 1.0 - hamming / phash.bit_len
                 hash_list.append([
                     name,
                     self.hash_size,
@@ -271,5 +534,5 @@ class pHashController(pHashBaseController):
     def __get_na_phash(self, files: list):
         for file in files:
             if "-na" in file or "na-" in file:
-                img = Image.open(file)
-                return str(self.get_phash(img))
+                with Image.open(file) as img:
+                    return pBitHash.from_imagehash(self.get_phash(img))
@@ -0,0 +1,196 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import utils
+from mconfig import config
+
+#######################################
+# Stage spans, counters and trace export
+#######################################
+
+
+class pProfiler:
+    """
+    Records named spans (wall time per stage call) and counters of a run.
+    Stages listed in config["profile_stages"] are also run under cProfile.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter_ns()
+        self.events: list = []
+        self.counters: dict = defaultdict(float)
+        self.lock = threading.Lock()
+        self.active_profile = None
+
+    def reset(self):
+        self.__init__()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        profile = None
+        if name in config.get("profile_stages", []) and \
+                self.active_profile is None:
+            profile = self.active_profile = cProfile.Profile()
+            profile.enable()
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            if profile is not None:
+                profile.disable()
+                self.active_profile = None
+                self.dump_profile(name, profile)
+            with self.lock:
+                self.events.append({
+                    "name": name,
+                    "start": (start - self.origin) / 1e9,
+                    "duration": (end - start) / 1e9,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args
+                })
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Accumulates into the `{name}.s` and `{name}.n` counters without a
+        trace event, for per-file steps inside a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(f"{name}.s", time.perf_counter() - start)
+            self.count(f"{name}.n")
+
+    def count(self, name: str, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def dump_profile(self, name: str, profile: cProfile.Profile):
+        folder = config.get("profile_output") or "."
+        utils.create_dir(folder)
+        idx = sum(1 for e in self.events if e["name"] == name)
+        profile.dump_stats(os.path.join(folder, f"{name}-{idx}.prof"))
+
+    def summary(self) -> dict:
+        """
+        Calls, total and max seconds per span name
+        """
+        stages: dict = {}
+        for event in self.events:
+            stage = stages.setdefault(event["name"], {
+                "calls": 0,
+                "total_s": 0.0,
+                "max_s": 0.0
+            })
+            stage["calls"] += 1
+            stage["total_s"] += event["duration"]
+            stage["max_s"] = max(stage["max_s"], event["duration"])
+        return stages
+
+    def to_dict(self) -> dict:
+        return {
+            "origin": self.origin,
+            "stages": self.summary(),
+            "counters": dict(self.counters),
+            "events": self.events
+        }
+
+    def merge(self, profile: dict):
+        """
+        Adds the counters and events of a worker process' to_dict(), its
+        spans shifted onto this profiler's timeline
+        """
+        shift = (profile.get("origin", self.origin) - self.origin) / 1e9
+        with self.lock:
+            for name, value in profile["counters"].items():
+                self.counters[name] += value
+            self.events += [{
+                **event, "start": event["start"] + shift
+            } for event in profile["events"]]
+
+    def to_chrome_trace(self) -> dict:
+        """
+        Complete ("X") events and final counter values ("C") in the Chrome
+        trace event format, viewable in chrome://tracing or Perfetto
+        """
+        trace = [{
+            "name": e["name"],
+            "cat": e["name"].split(".")[0],
+            "ph": "X",
+            "ts": e["start"] * 1e6,
+            "dur": e["duration"] * 1e6,
+            "pid": e["pid"],
+            "tid": e["tid"],
+            "args": e["args"]
+        } for e in self.events]
+        end = max([e["start"] + e["duration"] for e in self.events] or [0])
+        trace += [{
+            "name": name,
+            "ph": "C",
+            "ts": end * 1e6,
+            "pid": os.getpid(),
+            "args": {
+                "value": value
+            }
+        } for name, value in self.counters.items()]
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def save(self, path: str, chrome_trace=False):
+        utils.create_dir(os.path.dirname(path) or ".")
+        data = self.to_chrome_trace() if chrome_trace else self.to_dict()
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, default=str)
+
+    def print_summary(self):
+        for name, stage in sorted(self.summary().items(),
+                                  key=lambda item: -item[1]["total_s"]):
+            print(f"{name}: {stage['total_s']:.3f}s in {stage['calls']} calls")
+        for name, value in sorted(self.counters.items()):
+            print(f"{name}: {value:,.3f}" if isinstance(value, float) and
+                  not value.is_integer() else f"{name}: {int(value):,}")
+
+
+profiler = pProfiler()
+
+
+def get_profiler() -> pProfiler:
+    return profiler
+
+
+def profiled(name: str):
+    """
+    Decorator wrapping every call of a function in a span
+    """
+
+    def decorator(fn):
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profiler.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def save_run_profile(folder=None) -> str:
+    """
+    Writes the JSON profile and Chrome trace of this run to
+    config["profile_output"], returns the JSON path
+    """
+    folder = folder or config.get("profile_output")
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(folder, f"profile-{stamp}.json")
+    profiler.save(path)
+    profiler.save(os.path.join(folder, f"profile-{stamp}.trace.json"), True)
+    return path
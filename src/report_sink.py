@@ -0,0 +1,137 @@
+import os
+from abc import ABC, abstractmethod
+from glob import glob
+import pandas as pd
+import utils
+from mconfig import config
+from profiler import profiler
+
+#######################################
+# Report sinks (columnar partitions + optional Excel)
+#######################################
+
+EXCEL_MAX_ROWS = 1048575  # 2**20 minus the header row
+
+
+def get_report_name(table: str, image_set: str) -> str:
+    """
+    Legacy report name, e.g. "single", "single-fpos" or "single-stats"
+    """
+    return f"{image_set}-{table}" if table in ("fpos", "stats") else image_set
+
+
+class pReportSink(ABC):
+    """
+    Writes one report table of a hash_size and image set
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @abstractmethod
+    def write(self, df: pd.DataFrame, table: str, image_set: str,
+              hash_size: int):
+        pass
+
+
+class pColumnarSink(pReportSink):
+    """
+    Parquet or Feather files partitioned hive style as
+    {root}/{table}/hash_size={hash_size}/image_set={image_set}/part-0.{fmt}
+    """
+
+    def __init__(self, root: str, fmt="parquet"):
+        super().__init__(root)
+        if fmt not in ("parquet", "feather"):
+            raise ValueError(f"Unknown columnar format: {fmt}")
+        self.fmt = fmt
+
+    def get_partition(self, table: str, image_set: str, hash_size: int) -> str:
+        return os.path.join(self.root, table, f"hash_size={hash_size}",
+                            f"image_set={image_set}")
+
+    def write(self, df: pd.DataFrame, table: str, image_set: str,
+              hash_size: int):
+        folder = self.get_partition(table, image_set, hash_size)
+        utils.create_dir(folder)
+        path = os.path.join(folder, f"part-0.{self.fmt}")
+        with profiler.span(f"report.{self.fmt}", table=table, rows=df.__len__()):
+            if self.fmt == "parquet":
+                df.to_parquet(path)
+            else:
+                df.reset_index().to_feather(path)  # Feather has no index
+        profiler.count(f"report.{self.fmt}_rows", df.__len__())
+
+
+class pExcelSink(pReportSink):
+    """
+    Full tables as the legacy hash-{hash_size}-{name}-output.xlsx
+    workbooks the reporter reads, tables above Excel's row limit are
+    skipped. Slow (openpyxl), off unless config["report_excel"] is set.
+    """
+
+    def write(self, df: pd.DataFrame, table: str, image_set: str,
+              hash_size: int):
+        name = get_report_name(table, image_set)
+        if df.__len__() > EXCEL_MAX_ROWS:
+            print(f"Skipped Excel export of {name} ({hash_size}):",
+                  f"{df.__len__()} rows exceed {EXCEL_MAX_ROWS}")
+            return
+        with profiler.span("report.xlsx", table=table, rows=df.__len__()):
+            df.to_excel(f"{self.root}/hash-{hash_size}-{name}-output.xlsx")
+        profiler.count("report.xlsx_rows", df.__len__())
+
+
+class pMultiSink(pReportSink):
+    """
+    Fans every table out to several sinks
+    """
+
+    def __init__(self, sinks: list):
+        super().__init__(None)
+        self.sinks = sinks
+
+    def write(self, df: pd.DataFrame, table: str, image_set: str,
+              hash_size: int):
+        for sink in self.sinks:
+            sink.write(df, table, image_set, hash_size)
+
+
+def get_report_sink(root=None) -> pReportSink:
+    """
+    Sink for config["report_formats"], plus the legacy Excel workbooks
+    when config["report_excel"] is set
+    """
+    root = root or str(config.get("reports_output"))
+    utils.create_dir(root)
+    sinks = [
+        pColumnarSink(root, fmt) for fmt in config.get("report_formats", [])
+    ]
+    if config.get("report_excel", False):
+        sinks.append(pExcelSink(root))
+    return pMultiSink(sinks)
+
+
+def read_report(table: str,
+                image_set=None,
+                hash_size=None,
+                root=None,
+                fmt="parquet") -> pd.DataFrame:
+    """
+    Concatenates the partitions of a table, with hash_size and image_set
+    as columns
+    """
+    root = root or str(config.get("reports_output"))
+    pattern = os.path.join(root, table, f"hash_size={hash_size or '*'}",
+                           f"image_set={image_set or '*'}", f"*.{fmt}")
+    frames = []
+    for path in sorted(glob(pattern)):
+        parts = path.split(os.sep)
+        df = pd.read_parquet(path) if fmt == "parquet" else pd.read_feather(
+            path)
+        df["hash_size"] = int(parts[-3].split("=", 1)[1])
+        df["image_set"] = parts[-2].split("=", 1)[1]
+        frames.append(df)
+    if frames.__len__() == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,238 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import utils
+from bithash import lower_triangle_pairs, pack_hashes
+from mconfig import config
+
+#######################################
+# Threshold sweep / ROC from distance histograms
+#   python roc.py --sets single versions --hash-sizes 8 16
+#   python roc.py --thresholds 0.8 0.85 0.9 --store ./assets/store
+#######################################
+
+
+def threshold_distances(thresholds, bit_len: int) -> np.ndarray:
+    """
+    Vectorized bithash.threshold_to_distance, -1 where no distance passes
+    """
+    norms = 1.0 - np.arange(bit_len + 1) / bit_len  # Descending
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    return np.searchsorted(-norms, -thresholds, side="right") - 1
+
+
+class pRocCurve:
+    """
+    Genuine (variant vs. own APH) and impostor (APH vs. APH of another
+    asset) hamming distance histograms of one hash_size. Every threshold
+    maps to a distance cut, so FAR/FRR of any number of thresholds are
+    cumulative-sum lookups.
+    """
+
+    def __init__(self, hash_size: int, genuine: np.ndarray,
+                 impostor: np.ndarray):
+        self.hash_size = hash_size
+        self.bit_len = hash_size * hash_size
+        self.genuine = np.asarray(genuine, dtype=np.int64)
+        self.impostor = np.asarray(impostor, dtype=np.int64)
+        # Accepted pairs at distance <= d, index 0 is the d = -1 cut
+        self.genuine_accepted = np.concatenate(([0], np.cumsum(self.genuine)))
+        self.impostor_accepted = np.concatenate(([0],
+                                                 np.cumsum(self.impostor)))
+
+    def rates_at_distance(self, distances) -> tuple:
+        """
+        (FAR, FRR) when pairs with hamming <= distance are accepted
+        """
+        idx = np.asarray(distances) + 1
+        far = self.impostor_accepted[idx] / max(self.impostor.sum(), 1)
+        frr = 1.0 - self.genuine_accepted[idx] / max(self.genuine.sum(), 1)
+        return far, frr
+
+    def rates(self, thresholds) -> tuple:
+        """
+        (FAR, FRR) of normalized similarity thresholds (norm >= threshold)
+        """
+        return self.rates_at_distance(
+            threshold_distances(thresholds, self.bit_len))
+
+    def curve(self) -> dict:
+        """
+        Every operating point, from accepting nothing to accepting all
+        """
+        distances = np.arange(-1, self.bit_len + 1)
+        far, frr = self.rates_at_distance(distances)
+        return {
+            "distance": distances,
+            "threshold": 1.0 - distances / self.bit_len,
+            "far": far,
+            "frr": frr,
+            "tpr": 1.0 - frr
+        }
+
+    def optimal_threshold(self, far_weight=1.0) -> dict:
+        """
+        Operating point minimizing far_weight * FAR + FRR
+        """
+        curve = self.curve()
+        idx = int(np.argmin(far_weight * curve["far"] + curve["frr"]))
+        return {key: values[idx].item() for key, values in curve.items()}
+
+    def equal_error_rate(self) -> float:
+        curve = self.curve()
+        idx = int(np.argmin(np.abs(curve["far"] - curve["frr"])))
+        return float((curve["far"][idx] + curve["frr"][idx]) / 2)
+
+    def auc(self) -> float:
+        curve = self.curve()
+        tpr, far = curve["tpr"], curve["far"]
+        return float(np.sum(np.diff(far) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def to_arrays(self, prefix="") -> dict:
+        arrays = {
+            f"{prefix}genuine": self.genuine,
+            f"{prefix}impostor": self.impostor
+        }
+        arrays.update({
+            f"{prefix}{key}": values
+            for key, values in self.curve().items()
+        })
+        return arrays
+
+
+def genuine_histogram(df: pd.DataFrame, bit_len: int) -> np.ndarray:
+    """
+    Distances of the manipulated variants (value != "na") of an average
+    table to the APH of their own set
+    """
+    hamming = df.loc[df["value"].astype(str) != "na", "ham"]
+    return np.bincount(hamming.to_numpy(dtype=np.int64),
+                       minlength=bit_len + 1)
+
+
+def impostor_histogram(aphs: np.ndarray, modules, bit_len: int,
+                       block_size=512) -> np.ndarray:
+    """
+    Distances between the APHs of different assets, accumulated per block
+    so the pair list is never materialized
+    """
+    hist = np.zeros(bit_len + 1, dtype=np.int64)
+    if aphs.shape[0] < 2:
+        return hist
+    for _, _, hamming in lower_triangle_pairs(
+            aphs,
+            block_size=block_size,
+            distinct=(pd.factorize(np.asarray(modules))[0], )):
+        hist += np.bincount(hamming, minlength=bit_len + 1)
+    return hist
+
+
+def from_table(df: pd.DataFrame, hash_size: int,
+               block_size=512) -> pRocCurve:
+    """
+    Curve of a create_mhash_average_sheet table
+    """
+    bit_len = hash_size * hash_size
+    sets = df[["module", "ave-hash"]].astype(str).drop_duplicates()
+    return pRocCurve(
+        hash_size, genuine_histogram(df, bit_len),
+        impostor_histogram(pack_hashes(sets["ave-hash"].tolist()),
+                           sets["module"].to_numpy(), bit_len, block_size))
+
+
+def from_store(root: str, hash_size: int, image_set: str,
+               block_size=512) -> pRocCurve:
+    """
+    Curve of the rows of one image set in a hash store, reading the packed
+    hashes in place
+    """
+    from hash_store import open_store
+    store = open_store(root, hash_size)
+    bit_len = store.bit_len
+    in_set = store.column("image_set") == image_set
+    manipulated = in_set & (store.column("value") != "na")
+    genuine = np.bincount(store.hamming_to_aph()[manipulated],
+                          minlength=bit_len + 1)
+    aph_idx, first = np.unique(store.rows["aph"][in_set], return_index=True)
+    modules = store.rows["module"][in_set][first]
+    return pRocCurve(
+        hash_size, genuine,
+        impostor_histogram(store.aphs[aph_idx], modules, bit_len, block_size))
+
+
+def get_curves(image_set: str, hash_sizes: list, store=None) -> dict:
+    """
+    {hash_size: pRocCurve} from the columnar average reports (or a store)
+    """
+    from report_sink import read_report
+    curves = {}
+    for hash_size in hash_sizes:
+        if store is not None:
+            curve = from_store(store, hash_size, image_set)
+            if curve.genuine.sum() + curve.impostor.sum() > 0:
+                curves[hash_size] = curve
+            continue
+        df = read_report("average", image_set, hash_size)
+        if df.__len__() > 0:
+            curves[hash_size] = from_table(df, hash_size)
+    return curves
+
+
+def save_curves(curves: dict, path: str, thresholds=None):
+    """
+    Compact npz with the histograms and curve of every hash_size, plus
+    FAR/FRR at the given thresholds
+    """
+    arrays = {}
+    for hash_size, curve in curves.items():
+        arrays.update(curve.to_arrays(f"h{hash_size}_"))
+        if thresholds is not None:
+            far, frr = curve.rates(thresholds)
+            arrays[f"h{hash_size}_sweep_far"] = far
+            arrays[f"h{hash_size}_sweep_frr"] = frr
+    if thresholds is not None:
+        arrays["sweep_thresholds"] = np.asarray(thresholds, dtype=np.float64)
+    utils.create_dir(os.path.dirname(path) or ".")
+    np.savez_compressed(path, **arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="FAR/FRR sweep over ave_threshold values")
+    parser.add_argument("--sets", nargs="+", default=["single"])
+    parser.add_argument("--hash-sizes",
+                        type=int,
+                        nargs="+",
+                        default=config["hash_sizes"])
+    parser.add_argument("--thresholds",
+                        type=float,
+                        nargs="+",
+                        help="Defaults to 0.50 .. 1.00 in 0.01 steps")
+    parser.add_argument("--store", help="Read a hash store instead of reports")
+    parser.add_argument("--output", default=config.get("roc_output"))
+    args = parser.parse_args()
+
+    thresholds = np.asarray(args.thresholds or np.round(
+        np.arange(0.5, 1.001, 0.01), 2))
+    for image_set in args.sets:
+        key = "ave_threshold_versions" if image_set == "versions" \
+            else "ave_threshold"
+        curves = get_curves(image_set, args.hash_sizes, args.store)
+        for hash_size, curve in curves.items():
+            best = curve.optimal_threshold()
+            far, frr = curve.rates([config[key]])
+            print(
+                f"{image_set} hash {hash_size}: optimal {best['threshold']:.3f}"
+                f" FAR {best['far']:.2%} FRR {best['frr']:.2%}",
+                f"| EER {curve.equal_error_rate():.2%}",
+                f"| AUC {curve.auc():.4f}",
+                f"| {key} {config[key]}: FAR {far[0]:.2%} FRR {frr[0]:.2%}")
+        if curves.__len__() > 0 and args.output is not None:
+            path = os.path.join(args.output, f"roc-{image_set}.npz")
+            save_curves(curves, path, thresholds)
+            print("Saved:", path)
+
+
+if __name__ == "__main__":
+    main()
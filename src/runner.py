@@ -0,0 +1,439 @@
+import hashlib
+import importlib.util
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from fnmatch import fnmatch
+from glob import glob
+import utils
+from mconfig import config
+from profiler import profiler
+
+#######################################
+# Stage graph job runner
+#######################################
+
+IMAGE_SETS = {
+    "single": {
+        "generate": "generate_single_images",
+        "stream": "stream_single_images",
+        "kwargs": {
+            "output_folder": "single/",
+            "input": "./assets/original/single/*"
+        },
+        "input": "./assets/original/single/*",
+        "folder": "single/*/",
+        "selectors": ("res-*", "mpl-*"),
+        "image_set_type": "single",
+        "include_ave": True,
+        "fpos_label": "single"
+    },
+    "wires_only": {
+        "generate": "generate_single_images",
+        "stream": "stream_single_images",
+        "kwargs": {
+            "output_folder": "wires_only/",
+            "input": "./assets/original/gerbers/wires_only/*"
+        },
+        "input": "./assets/original/gerbers/wires_only/*",
+        "folder": "wires_only/*/",
+        "selectors": ("res-*", "mpl-*"),
+        "image_set_type": "wires_only",
+        "include_ave": True,
+        "fpos_label": "run_wires_only"
+    },
+    "cropped": {
+        "generate": "generate_images_cropped",
+        "stream": "stream_images_cropped",
+        "kwargs": {
+            "pre_crop_frame": 0.95
+        },
+        "input": "./assets/original/single/*",
+        "folder": "cropped/*/",
+        "selectors": ("res-*", "cropped-*"),
+        "image_set_type": "single",
+        "include_ave": False,
+        "fpos_label": None
+    },
+    "versions": {
+        "generate": "generate_images_versions",
+        "stream": "stream_images_versions",
+        "kwargs": {},
+        "input": "./assets/original/versions/*/*",
+        "folder": "versions/*/",
+        "selectors": ("res-*", "res-*"),
+        "image_set_type": "versions",
+        "include_ave": True,
+        "fpos_label": None
+    },
+}
+
+GENERATE_KEYS = ("resolution_scale_width", "crop_sizes", "mpl_tile_sizes",
+                 "mpl_tile_angle")
+HASH_KEYS = ("high_freq_factor", "phash_resize_mode", "ave_threshold",
+             "ave_threshold_versions", "report_excel")
+COMPARE_KEYS = ("ave_threshold", "fpos_only_valid", "report_excel")
+
+
+class pStage:
+    """
+    Node of the job graph. A stage is up to date when its outputs exist and
+    the fingerprint of its params, config keys, input files and upstream
+    fingerprints matches the one of its last successful run.
+    """
+
+    def __init__(self,
+                 name: str,
+                 fn,
+                 params=None,
+                 deps=(),
+                 inputs=(),
+                 outputs=(),
+                 config_keys=()):
+        self.name = name
+        self.fn = fn
+        self.params = params or {}
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config_keys = list(config_keys)
+
+    def get_fingerprint(self, upstream: dict) -> str:
+        files = []
+        for pattern in self.inputs:
+            for path in sorted(glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    st = os.stat(path)
+                    files.append((path, st.st_size, st.st_mtime_ns))
+        data = {
+            "params": self.params,
+            "config": {k: config.get(k)
+                       for k in self.config_keys},
+            "files": files,
+            "deps": [upstream[dep] for dep in self.deps]
+        }
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True,
+                       default=str).encode()).hexdigest()
+
+    def has_outputs(self) -> bool:
+        """
+        Stages without declared outputs cannot be checked and always run
+        """
+        return self.outputs.__len__() > 0 and all(
+            glob(pattern) for pattern in self.outputs)
+
+
+def run_stage(fn, params: dict, config_snapshot: dict, isolated=True):
+    """
+    Entry point of a stage in a worker process, config is process global
+
+    :return: The worker's profile when isolated, merged by the runner
+    """
+    config.update(config_snapshot)
+    if "hash_size" in params:
+        config["hash_size"] = params["hash_size"]
+    if isolated:
+        profiler.reset()
+    with profiler.span(f"stage.{fn.__name__}", **params):
+        fn(**params)
+    return profiler.to_dict() if isolated else None
+
+
+class pJobRunner:
+
+    def __init__(self, stages: list, state_path: str, workers=None,
+                 force=False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.workers = workers
+        self.force = force
+        self.state: dict = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+    def select(self, patterns=None) -> list:
+        """
+        Stage names matching any pattern plus everything upstream of them
+        """
+        if not patterns:
+            return list(self.stages)
+        selected = set()
+        todo = [n for n in self.stages if any(fnmatch(n, p) for p in patterns)]
+        while todo:
+            name = todo.pop()
+            if name not in selected:
+                selected.add(name)
+                todo += self.stages[name].deps
+        return [n for n in self.stages if n in selected]
+
+    def save_state(self):
+        utils.create_dir(os.path.dirname(self.state_path) or ".")
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+
+    def run(self, patterns=None, dry_run=False) -> dict:
+        """
+        Runs the selected stages as soon as their dependencies are done,
+        independent stages concurrently on a process pool
+
+        :return: Status per stage: done, skipped, failed or blocked
+        """
+        names = self.select(patterns)
+        status: dict = {}
+        fingerprints: dict = {}
+        running: dict = {}
+        executor = None
+        if not dry_run and self.workers != 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        try:
+            while status.__len__() < names.__len__():
+                for name in names:
+                    stage = self.stages[name]
+                    if name in status or name in running.values():
+                        continue
+                    deps = [status.get(dep) for dep in stage.deps]
+                    if any(s in ("failed", "blocked") for s in deps):
+                        status[name] = "blocked"
+                        continue
+                    if not all(s in ("done", "skipped") for s in deps):
+                        continue
+
+                    fingerprint = stage.get_fingerprint(fingerprints)
+                    fingerprints[name] = fingerprint
+                    if not self.force and stage.has_outputs() and \
+                            self.state.get(name) == fingerprint:
+                        status[name] = "skipped"
+                    elif dry_run:
+                        status[name] = "done"
+                        print("Would run:", name)
+                    elif executor is None:
+                        self.__finish(name, status, fingerprint,
+                                      lambda: run_stage(stage.fn, stage.params,
+                                                        dict(config), False))
+                    else:
+                        running[executor.submit(run_stage, stage.fn,
+                                                stage.params,
+                                                dict(config))] = name
+
+                if running.__len__() == 0:
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    self.__finish(name, status, fingerprints[name],
+                                  future.result)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        return status
+
+    def __finish(self, name: str, status: dict, fingerprint: str, result):
+        try:
+            worker_profile = result()
+        except Exception as e:
+            status[name] = "failed"
+            print(f"Stage {name} failed: {e}")
+            return
+        status[name] = "done"
+        self.state[name] = fingerprint
+        self.save_state()
+        if worker_profile is not None:
+            profiler.merge(worker_profile)
+        print("Finished:", name)
+
+
+def get_img_ctrl():
+    from image_ctrl import pImageController
+    return pImageController(config)
+
+
+def get_mhash_ctrl():
+    from mhash_ctrl import MultiHashController
+    return MultiHashController(get_img_ctrl(), config)
+
+
+def stage_generate(image_set: str, limit=None):
+    spec = IMAGE_SETS[image_set]
+    folder = spec["folder"].split("/")[0]
+    utils.delete_folder(f"./assets/output/{folder}/*/")
+    errors = getattr(get_img_ctrl(), spec["generate"])(stop_after=limit,
+                                                       **spec["kwargs"])
+    if errors.__len__() > 0:
+        raise RuntimeError(
+            f"{errors.__len__()} image(s) of {image_set} failed to generate")
+
+
+def stage_hash(image_set: str, hash_size: int, limit=None, in_memory=False,
+               persist=()):
+    spec = IMAGE_SETS[image_set]
+    mhash_ctrl = get_mhash_ctrl()
+    variant_sets = None
+    if in_memory:
+        variant_sets = getattr(mhash_ctrl.img_ctrl, spec["stream"])(
+            stop_after=limit, persist=persist, **spec["kwargs"])
+    mhash_ctrl.create_mhash_average_sheet(spec["folder"],
+                                          *spec["selectors"],
+                                          spec["image_set_type"],
+                                          spec["include_ave"],
+                                          variant_sets=variant_sets)
+
+
+def stage_compare(image_set: str, hash_size: int):
+    from report_sink import read_report
+    df = read_report("average", image_set, hash_size)
+    df = df.drop(columns=["hash_size", "image_set"], errors="ignore")
+    get_mhash_ctrl().create_mhash_false_positive_sheet(
+        df, IMAGE_SETS[image_set]["fpos_label"])
+
+
+def stage_stats(image_set: str, hash_sizes: list):
+    from report_sink import get_report_sink
+    from stats import report_stats
+    df = report_stats("average", image_set)
+    if df.__len__() == 0:
+        return
+    sink = get_report_sink()
+    for hash_size, group in df[df["hash_size"].isin(hash_sizes)].groupby(
+            "hash_size"):
+        sink.write(group.reset_index(drop=True), "stats", image_set,
+                   int(hash_size))
+
+
+def stage_mpls(hash_size: int):
+    get_mhash_ctrl().create_mpls_sheet()
+
+
+def stage_report(image_sets: list, mpls: bool):
+    import reporter
+    out = config.get('reports_output')
+    if "cropped" in image_sets:
+        reporter.create_crop_report()
+    for image_set in ("single", "versions", "wires_only"):
+        if image_set not in image_sets:
+            continue
+        reporter.create_ave_report(f"{out}/hash-*-{image_set}-output.xlsx",
+                                   image_set)
+    if "single" in image_sets:
+        reporter.create_fpos_report(f"{out}/hash-*-single-fpos-output.xlsx",
+                                    "single")
+    if "wires_only" in image_sets:
+        reporter.create_fpos_report(
+            f"{out}/hash-*-run_wires_only-fpos-output.xlsx", "wires_only")
+    if mpls:
+        reporter.create_mpls_report(
+            f"{out}/hash-*-mpl_conduct_layout-output.xlsx", "conduct_layout")
+        reporter.create_mpls_report(f"{out}/hash-*-mpl_elements-output.xlsx",
+                                    "elements")
+        reporter.create_mpls_report_wires(
+            f"{out}/hash-*-mpl_conduct_width-output.xlsx", "conduct_width")
+        reporter.create_mpls_report_wires_only2(
+            f"{out}/hash-*-wire_only_mpls-output.xlsx", "wires_only_mpls")
+
+
+def get_pipeline_settings(excel: bool) -> dict:
+    """
+    Config the stages depend on: the compare and stats stages read the
+    parquet reports, the report stage reads the Excel workbooks
+    """
+    formats = list(config.get("report_formats", []))
+    if "parquet" not in formats:
+        formats.append("parquet")
+    return {"report_formats": formats, "report_excel": excel}
+
+
+def build_pipeline(hash_sizes: list,
+                   image_sets: list,
+                   limit=None,
+                   in_memory=False,
+                   persist=(),
+                   mpls=True,
+                   report=True) -> list:
+    """
+    generate:{set} -> hash:{set}:{size} -> compare:{set}:{size} -> report,
+    plus stats:{set} (grouped statistics of the average tables) and
+    mpls:{size}. In-memory hashing streams the variants itself and
+    has no generate stage, every hash:{set}:{size} stage streams them
+    again. The report stage is only added when the reporter module is
+    available, it needs the Excel workbooks of get_pipeline_settings().
+    """
+    out = str(config.get("reports_output"))
+    stages = []
+    for image_set in image_sets:
+        spec = IMAGE_SETS[image_set]
+        generated = f"./assets/output/{spec['folder']}"
+        if not in_memory:
+            stages.append(
+                pStage(f"generate:{image_set}",
+                       stage_generate, {
+                           "image_set": image_set,
+                           "limit": limit
+                       },
+                       inputs=[spec["input"]],
+                       outputs=[generated],
+                       config_keys=GENERATE_KEYS))
+        for hash_size in hash_sizes:
+            average = f"{out}/average/hash_size={hash_size}/image_set={image_set}/*"
+            stages.append(
+                pStage(f"hash:{image_set}:{hash_size}",
+                       stage_hash, {
+                           "image_set": image_set,
+                           "hash_size": hash_size,
+                           "limit": limit,
+                           "in_memory": in_memory,
+                           "persist": list(persist)
+                       },
+                       deps=[] if in_memory else [f"generate:{image_set}"],
+                       inputs=[spec["input"]] if in_memory else
+                       [f"{generated}**"],
+                       outputs=[average],
+                       config_keys=HASH_KEYS))
+            if spec["fpos_label"] is not None:
+                stages.append(
+                    pStage(f"compare:{image_set}:{hash_size}",
+                           stage_compare, {
+                               "image_set": image_set,
+                               "hash_size": hash_size
+                           },
+                           deps=[f"hash:{image_set}:{hash_size}"],
+                           outputs=[
+                               f"{out}/fpos/hash_size={hash_size}/"
+                               f"image_set={spec['fpos_label']}/*"
+                           ],
+                           config_keys=COMPARE_KEYS))
+        stages.append(
+            pStage(f"stats:{image_set}",
+                   stage_stats, {
+                       "image_set": image_set,
+                       "hash_sizes": list(hash_sizes)
+                   },
+                   deps=[f"hash:{image_set}:{size}" for size in hash_sizes],
+                   outputs=[
+                       f"{out}/stats/hash_size={size}/image_set={image_set}/*"
+                       for size in hash_sizes
+                   ],
+                   config_keys=("report_excel", )))
+    if mpls:
+        for hash_size in hash_sizes:
+            stages.append(
+                pStage(f"mpls:{hash_size}",
+                       stage_mpls, {"hash_size": hash_size},
+                       inputs=["./assets/original/mpls/**"],
+                       outputs=[
+                           f"{out}/mpls/hash_size={hash_size}/image_set=*/*"
+                       ],
+                       config_keys=HASH_KEYS))
+    if report and importlib.util.find_spec("reporter") is not None:
+        stages.append(
+            pStage("report",
+                   stage_report, {
+                       "image_sets": list(image_sets),
+                       "mpls": mpls
+                   },
+                   deps=[s.name for s in stages
+                         if not s.name.startswith("generate:")],
+                   inputs=[f"{out}/*.xlsx"],
+                   outputs=[]))
+    return stages
@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context
+import numpy as np
+from PIL import Image
+from merkle import sha256
+from mconfig import config
+
+#######################################
+# Async fingerprinting service
+#   python server.py serve --port 8765            (or --unix ./mhash.sock)
+#   python server.py client --port 8765 a.png b.gbr
+#
+#   POST /fingerprint   application/zip bundle, or
+#                       application/json {"files": [...]} of paths below
+#                       server_file_root (disabled when None)
+#   GET  /metrics       latency, throughput, queue and batch statistics
+#   GET  /health
+#######################################
+
+HTTP_STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+worker_ctrl = None
+
+
+def get_worker_ctrl():
+    """
+    MultiHashController of a pool process, created once
+    """
+    global worker_ctrl
+    if worker_ctrl is None:
+        from image_ctrl import pImageController
+        from mhash_ctrl import MultiHashController
+        worker_ctrl = MultiHashController(pImageController(config), config)
+    return worker_ctrl
+
+
+def fingerprint_batch(bundles: list, hash_size: int,
+                      is_version_set=False) -> list:
+    """
+    Manifests of several bundles of (name, bytes). The images of all
+    bundles go through one vectorized pHash pass, the APH and Merkle root
+    are then built per bundle.
+    """
+    from phash_ctrl import pHashController
+
+    config["hash_size"] = hash_size
+    mhash_ctrl = get_worker_ctrl()
+    image_extensions = Image.registered_extensions()
+
+    keys, images, owners = [], [], []
+    decoded = []
+    for b_idx, bundle in enumerate(bundles):
+        names = [name for name, _ in bundle]
+        image_names, bundle_images = mhash_ctrl.decode_images(
+            names, [
+                data if os.path.splitext(name)[1].lower() in image_extensions
+                else None for name, data in bundle
+            ])
+        decoded.append((names, [sha256(data) for _, data in bundle],
+                        image_names))
+        keys += [f"{b_idx}/{name}" for name in image_names]
+        images += bundle_images
+        owners += [b_idx] * image_names.__len__()
+
+    phash_ctrl = pHashController(keys, config, is_version_set, False, images)
+    hashes = phash_ctrl.phashes if keys.__len__() > 0 else []
+    owners = np.asarray(owners, dtype=np.int64)
+
+    manifests = []
+    for b_idx, (names, digests, image_names) in enumerate(decoded):
+        rows = np.nonzero(owners == b_idx)[0]
+        phashes = dict(zip(image_names, (str(hashes[r]) for r in rows)))
+        average_phash = None
+        if rows.size > 0:
+            phash_ctrl.get_average_hash([hashes[r] for r in rows])
+            average_phash = phash_ctrl.average_phash
+        manifests.append(
+            mhash_ctrl.get_manifest(names, digests, phashes, average_phash))
+    return manifests
+
+
+class pBundleTooLarge(ValueError):
+    pass
+
+
+def read_bundle(body: bytes, max_size=None) -> list:
+    """
+    (name, bytes) of every file in a zip bundle, in archive order
+
+    :param max_size: Max total uncompressed size, checked before reading
+    """
+    with zipfile.ZipFile(BytesIO(body)) as archive:
+        infos = [info for info in archive.infolist() if not info.is_dir()]
+        size = sum(info.file_size for info in infos)
+        if max_size is not None and size > max_size:
+            raise pBundleTooLarge(
+                f"bundle unpacks to {size} bytes, max {max_size}")
+        return [(info.filename, archive.read(info)) for info in infos]
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class pServerMetrics:
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = deque(maxlen=4096)
+        self.batch_sizes = deque(maxlen=4096)
+        self.counters = {
+            "requests": 0,
+            "completed": 0,
+            "rejected": 0,
+            "errors": 0,
+            "files": 0,
+            "bytes": 0
+        }
+
+    def to_dict(self, queue_depth: int, in_flight: int) -> dict:
+        uptime = time.monotonic() - self.started
+        latencies = np.asarray(self.latencies, dtype=np.float64)
+        percentiles = {
+            f"p{p}_ms": float(np.percentile(latencies, p) * 1000)
+            if latencies.size > 0 else None
+            for p in (50, 95, 99)
+        }
+        return {
+            **self.counters, "uptime_s": uptime,
+            "requests_per_s": self.counters["completed"] / uptime,
+            "files_per_s": self.counters["files"] / uptime,
+            "latency": percentiles,
+            "mean_batch_size": float(np.mean(self.batch_sizes))
+            if self.batch_sizes else None,
+            "queue_depth": queue_depth,
+            "in_flight_batches": in_flight
+        }
+
+
+class pFingerprintServer:
+    """
+    Bounded request queue in front of a process pool. Requests are rejected
+    with 503 when the queue is full, a batcher groups queued requests (up
+    to server_batch_size or server_batch_window seconds) into one pool task
+    and at most server_workers batches are in flight.
+    """
+
+    def __init__(self, workers=None, queue_size=None, batch_size=None,
+                 batch_window=None, hash_size=None, file_root=None):
+        self.workers = workers or config.get("server_workers", 2)
+        self.batch_size = batch_size or config.get("server_batch_size", 16)
+        self.batch_window = batch_window or config.get(
+            "server_batch_window", 0.01)
+        self.queue_size = queue_size or config.get("server_queue_size", 64)
+        self.hash_size = hash_size or config.get("hash_size") or 8
+        self.max_body = config.get("server_max_body", 1 << 28)
+        self.max_unpacked = config.get("server_max_unpacked", 1 << 30)
+        file_root = file_root or config.get("server_file_root")
+        self.file_root = None if file_root is None else os.path.realpath(
+            file_root)
+        self.metrics = pServerMetrics()
+        self.in_flight = 0
+        self.queue = None
+        self.executor = None
+
+    async def start(self, host="127.0.0.1", port=8765, unix_path=None):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.executor = self.create_executor()
+        self.batcher = asyncio.create_task(self.run_batcher())
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(
+                self.handle, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # Spawned, forking after asyncio.to_thread may inherit held locks
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=get_context("spawn"))
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        self.executor.shutdown(cancel_futures=True)
+
+    async def run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while batch.__len__() < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(
+                        self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.slots.acquire()
+            self.in_flight += 1
+            self.metrics.batch_sizes.append(batch.__len__())
+            asyncio.create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch: list):
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            manifests = await loop.run_in_executor(
+                executor, fingerprint_batch,
+                [bundle for bundle, _ in batch], self.hash_size)
+            for (_, future), manifest in zip(batch, manifests):
+                if not future.done():
+                    future.set_result(manifest)
+        except Exception as e:
+            # A dead worker breaks the pool for good, later batches get a
+            # new one (once, when several batches see the same break)
+            if isinstance(e, BrokenProcessPool) and self.executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.create_executor()
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    async def fingerprint(self, bundle: list) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((bundle, future))  # Raises QueueFull
+        return await future
+
+    def resolve_path(self, path: str) -> str:
+        """
+        Real path of a path mode file, which must lie below file_root
+        """
+        if self.file_root is None:
+            raise PermissionError("path mode is disabled")
+        real = os.path.realpath(os.path.join(self.file_root, path))
+        if os.path.commonpath([real, self.file_root]) != self.file_root:
+            raise PermissionError(f"{path} is outside the file root")
+        return real
+
+    async def get_bundle(self, headers: dict, body: bytes) -> list:
+        if headers.get("content-type", "").startswith("application/json"):
+            files = json.loads(body)["files"]
+            paths = [self.resolve_path(path) for path in files]
+            datas = await asyncio.gather(
+                *[asyncio.to_thread(read_file, path) for path in paths])
+            bundle = list(zip(files, datas))
+        else:
+            # Off the event loop, inflating blocks every connection
+            bundle = await asyncio.to_thread(read_bundle, body,
+                                             self.max_unpacked)
+        if bundle.__len__() == 0:
+            raise ValueError("empty bundle")
+        return bundle
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        start = time.monotonic()
+        status, payload = 500, {"error": "internal"}
+        try:
+            request = await reader.readline()
+            method, path, _ = request.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            if length > self.max_body:
+                status, payload = 413, {"error": "bundle too large"}
+            elif method == "GET" and path == "/health":
+                status, payload = 200, {"status": "ok"}
+            elif method == "GET" and path == "/metrics":
+                status, payload = 200, self.metrics.to_dict(
+                    self.queue.qsize(), self.in_flight)
+            elif method == "POST" and path == "/fingerprint":
+                self.metrics.counters["requests"] += 1
+                # Read even when rejecting, closing on unread data resets
+                # the connection before the client sees the 503
+                body = await reader.readexactly(length)
+                if self.queue.full():
+                    self.metrics.counters["rejected"] += 1
+                    status, payload = 503, {"error": "queue full, retry later"}
+                else:
+                    bundle = await self.get_bundle(headers, body)
+                    payload = await self.fingerprint(bundle)
+                    status = 200
+                    self.metrics.counters["completed"] += 1
+                    self.metrics.counters["files"] += bundle.__len__()
+                    self.metrics.counters["bytes"] += length
+                    self.metrics.latencies.append(time.monotonic() - start)
+            else:
+                status, payload = 404, {"error": f"no route {method} {path}"}
+        except asyncio.QueueFull:
+            self.metrics.counters["rejected"] += 1
+            status, payload = 503, {"error": "queue full, retry later"}
+        except pBundleTooLarge as e:
+            self.metrics.counters["errors"] += 1
+            status, payload = 413, {"error": str(e)}
+        except PermissionError as e:
+            self.metrics.counters["errors"] += 1
+            status, payload = 403, {"error": str(e)}
+        except (ValueError, KeyError, zipfile.BadZipFile, OSError) as e:
+            self.metrics.counters["errors"] += 1
+            status, payload = 400, {"error": str(e)}
+        except Exception as e:
+            self.metrics.counters["errors"] += 1
+            status, payload = 500, {"error": str(e)}
+
+        body = json.dumps(payload).encode()
+        retry = "Retry-After: 1\r\n" if status == 503 else ""
+        head = (f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {body.__len__()}\r\n{retry}"
+                f"Connection: close\r\n\r\n")
+        try:
+            writer.write(head.encode("latin-1") + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def make_bundle(files: list) -> bytes:
+    """
+    Zip bundle of local files, stored uncompressed under their base names
+    """
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for path in files:
+            archive.write(path, os.path.basename(path))
+    return buffer.getvalue()
+
+
+class pFingerprintClient:
+    """
+    Minimal HTTP client for the service over TCP or a Unix socket
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, unix_path=None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+
+    async def request(self, method: str, path: str, body=b"",
+                      content_type="application/zip") -> tuple:
+        if self.unix_path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write((f"{method} {path} HTTP/1.1\r\n"
+                      f"Host: {self.host}\r\n"
+                      f"Content-Type: {content_type}\r\n"
+                      f"Content-Length: {body.__len__()}\r\n\r\n").encode() +
+                     body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        return status, json.loads(payload)
+
+    async def fingerprint(self, files: list) -> tuple:
+        return await self.request("POST", "/fingerprint", make_bundle(files))
+
+    async def fingerprint_paths(self, files: list) -> tuple:
+        """
+        Lets the server read files below its file root instead of uploading
+        them, paths are relative to that root
+        """
+        body = json.dumps({"files": files})
+        return await self.request("POST", "/fingerprint", body.encode(),
+                                  "application/json")
+
+    async def metrics(self) -> dict:
+        return (await self.request("GET", "/metrics"))[1]
+
+
+async def serve(args):
+    server = pFingerprintServer(args.workers,
+                                args.queue_size,
+                                args.batch_size,
+                                hash_size=args.hash_size,
+                                file_root=args.file_root)
+    await server.start(args.host, args.port, args.unix)
+    print("Serving on", args.unix or f"{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+async def run_client(args):
+    client = pFingerprintClient(args.host, args.port, args.unix)
+    status, manifest = await client.fingerprint(args.files)
+    print(status, json.dumps(manifest, indent=1))
+    print(json.dumps(await client.metrics(), indent=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprinting service")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "client"):
+        p = sub.add_parser(name)
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--port", type=int, default=8765)
+        p.add_argument("--unix", help="Unix socket path instead of TCP")
+    serve_parser = sub.choices["serve"]
+    serve_parser.add_argument("--workers", type=int)
+    serve_parser.add_argument("--queue-size", type=int)
+    serve_parser.add_argument("--batch-size", type=int)
+    serve_parser.add_argument("--hash-size", type=int, default=8)
+    serve_parser.add_argument("--file-root",
+                              help="Enables path mode for files below it")
+    sub.choices["client"].add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args) if args.command == "serve" else run_client(args))
+
+
+if __name__ == "__main__":
+    main()
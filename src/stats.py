@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+#######################################
+# Vectorized report statistics
+#######################################
+
+# Grouping of the average tables, keys missing from a table are dropped
+GROUP_KEYS = ("hash_size", "mod", "image_set")
+
+
+def valid_rate(table: pd.DataFrame, valid_col="valid") -> float:
+    """
+    Share of truthy values in a column, 0 for an empty table
+    """
+    if table.__len__() == 0:
+        return 0
+    return float(table[valid_col].to_numpy(dtype=bool).mean())
+
+
+def column_mean(table: pd.DataFrame, col_name: str) -> float:
+    if table.__len__() == 0:
+        return 0
+    return float(table[col_name].to_numpy(dtype=np.float64).mean())
+
+
+def median_absolute_deviation(data, axis=None):
+    data = np.asarray(data, dtype=np.float64)
+    median = np.median(data, axis)
+    if axis is not None:
+        median = np.expand_dims(median, axis)
+    return np.median(np.abs(data - median), axis)
+
+
+def group_stats(table: pd.DataFrame,
+                by=GROUP_KEYS,
+                value_col="norm",
+                valid_col="valid") -> pd.DataFrame:
+    """
+    Validity rate, mean, median and median absolute deviation of value_col
+    per group, from one factorization of the group keys
+
+    :return: One row per group with rows, valid_rate, mean, median, mad
+    """
+    by = [key for key in by if key in table.columns]
+    columns = ["rows", "valid_rate", "mean", "median", "mad"]
+    if table.__len__() == 0:
+        return pd.DataFrame(columns=by + columns)
+    values = table[value_col].to_numpy(dtype=np.float64)
+    valid = table[valid_col].to_numpy(dtype=bool)
+    if by.__len__() == 0:
+        codes = np.zeros(values.size, dtype=np.int64)
+        keys = pd.DataFrame(index=range(1))
+    else:
+        grouped = table.groupby(by, sort=True, observed=True, dropna=False)
+        codes = grouped.ngroup().to_numpy()
+        keys = grouped.size().index.to_frame(index=False)
+
+    # Sort once by (group, value), medians are then positional lookups
+    order = np.lexsort((values, codes))
+    codes, values, valid = codes[order], values[order], valid[order]
+    n_groups = keys.__len__()
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    def group_median(sorted_values):
+        lo = starts + (counts - 1) // 2
+        hi = starts + counts // 2
+        return (sorted_values[lo] + sorted_values[hi]) / 2
+
+    median = group_median(values)
+    deviation = np.abs(values - median[codes])
+    deviation = deviation[np.lexsort((deviation, codes))]
+
+    keys["rows"] = counts
+    keys["valid_rate"] = np.bincount(codes, valid, n_groups) / counts
+    keys["mean"] = np.bincount(codes, values, n_groups) / counts
+    keys["median"] = median
+    keys["mad"] = group_median(deviation)
+    return keys
+
+
+def report_stats(table: str, image_set=None, hash_size=None,
+                 **kwargs) -> pd.DataFrame:
+    """
+    group_stats of a columnar report across all its hash_size partitions
+    """
+    from report_sink import read_report
+    return group_stats(read_report(table, image_set, hash_size), **kwargs)
@@ -1,7 +1,7 @@
-from numpy import median, absolute
 import decimal
 import pandas as pd
-import distance
+import stats
+from bithash import pBitHash
 from glob import glob
 import os
 import zipfile
@@ -12,37 +12,28 @@ ctx.prec = 3
 
 
 def count_valid_rows(table: pd.DataFrame, valid_filter) -> float:
-    valid = 0
-
-    for _, row in table.iterrows():
-        is_valid = bool(row.__getitem__(valid_filter))
-
-        if is_valid:
-            # print("VALID:", row.__getitem__("name_a"))
-            valid += 1
-
-    return valid if valid <= 0 else valid/table.__len__()
+    return stats.valid_rate(table, valid_filter)
 
 
 def sum_column_average(table: pd.DataFrame, col_name: str) -> float:
-    if table.__len__() == 0:
-        return 0
-    return sum(table.__getitem__(col_name))/table.__len__()
+    return stats.column_mean(table, col_name)
 
 def to_percent(val, digits=2):
     val *= 10 ** (digits + 2)
     return '{1:.{0}f}%'.format(digits, floor(val) / 10 ** digits)
 
-def get_phash_distance(hashA: str, hashB: str):
+def get_phash_distance(hashA, hashB):
     """
-    Passing the bit length of the phash which is different from the str length
-    to calculate the normalized hamming distance.
+    Bit hamming distance and normalized similarity of two hashes given as
+    hex strings or pBitHash.
     """
-    # bit_len = phash_size**2
-    str_len = hashA.__len__()
+    if not isinstance(hashA, pBitHash):
+        hashA = pBitHash.from_hex(str(hashA))
+    if not isinstance(hashB, pBitHash):
+        hashB = pBitHash.from_hex(str(hashB))
 
-    hamming = distance.hamming(hashA, hashB)
-    normalized = 1.0 - (hamming / str_len)
+    hamming = hashA.hamming(hashB)
+    normalized = 1.0 - (hamming / hashA.bit_len)
 
     return (hamming, normalized)
 
@@ -57,7 +48,7 @@ def float_to_str(f):
 
 
 def median_absolute_deviation(data, axis=None):
-    return median(absolute(data - median(data, axis)), axis)
+    return stats.median_absolute_deviation(data, axis)
 
 
 def add_tex_mid_rules(latex: str, indices: list[int], line_offset: int) -> str:
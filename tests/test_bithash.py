@@ -0,0 +1,30 @@
+import numpy as np
+from bithash import pAverageHash
+
+HASH_SIZE = 8
+
+
+def test_average_hash_of_unpacked_and_packed_bits():
+    rng = np.random.default_rng(0)
+    bits = rng.random((5, HASH_SIZE, HASH_SIZE)) > 0.5
+    expected = pAverageHash(HASH_SIZE**2).add(bits).get_bits()
+
+    # 0/1 uint8 rows as wide as the packed form must not be unpacked again
+    unpacked = pAverageHash(HASH_SIZE**2).add(bits.astype(np.uint8))
+    packed = pAverageHash(HASH_SIZE**2).add(
+        np.packbits(bits.reshape(5, -1), axis=1), packed=True)
+    assert (unpacked.get_bits() == expected).all()
+    assert (packed.get_bits() == expected).all()
+    assert (expected == (bits.reshape(5, -1).sum(axis=0) > 2.5)).all()
+
+
+def test_add_average_hash_without_average(monkeypatch):
+    import imagehash
+    from mconfig import config
+    from phash_ctrl import pHashController
+
+    monkeypatch.setitem(config, "hash_size", HASH_SIZE)
+    bits = np.eye(HASH_SIZE, dtype=bool)
+    ctrl = pHashController([], config, False, False)
+    assert ctrl.add_average_hash(imagehash.ImageHash(bits)) == \
+        imagehash.ImageHash(bits)
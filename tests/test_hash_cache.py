@@ -0,0 +1,23 @@
+import os
+from hash_cache import pHashCache
+
+
+def test_file_digests_outlive_hash_eviction(tmp_path):
+    paths = []
+    for idx in range(4):
+        path = tmp_path / f"layer{idx}.gbr"
+        path.write_text(str(idx))
+        paths.append(str(path))
+    cache = pHashCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+
+    digests = cache.file_digests(paths[:2])
+    cache.db.execute("UPDATE files SET atime = 0 WHERE path = ?",
+                     (os.path.abspath(paths[1]), ))
+    cache.put_many(digests[:1], "phash", [b"\x01"])
+    # Merkle-only files without a hash row are not evicted with the hashes
+    assert cache.db.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 2
+
+    cache.file_digests(paths[2:])
+    kept = [row[0] for row in cache.db.execute("SELECT path FROM files")]
+    assert os.path.abspath(paths[1]) not in kept  # Least recently used
+    assert kept.__len__() == 3
@@ -0,0 +1,39 @@
+import numpy as np
+from bithash import pBitHash
+from hash_index import get_index_path, pHashIndex
+
+HASH_SIZE = 8
+
+
+def make_index(n: int, seed=0):
+    rng = np.random.default_rng(seed)
+    hashes = [pBitHash.from_bool(rng.random(HASH_SIZE**2) > 0.5)
+              for _ in range(n)]
+    index = pHashIndex(HASH_SIZE)
+    for idx, h in enumerate(hashes):
+        index.insert(f"asset-{idx}", h)
+    return index, hashes
+
+
+def test_knn_matches_brute_force():
+    index, hashes = make_index(200)
+    query = hashes[7]
+    distances = sorted(query.hamming(h) for h in hashes)
+    rows = index.query_knn(query, 10)
+    assert [d for _, d, _ in rows] == distances[:10]
+    assert rows[0][0] == "asset-7"
+
+
+def test_knn_without_results():
+    index, hashes = make_index(20)
+    assert index.query_knn(hashes[0], 0) == []
+    assert index.query_knn(hashes[0], -1) == []
+    assert pHashIndex(HASH_SIZE).query_knn(hashes[0], 3) == []
+
+
+def test_open_loads_or_creates(tmp_path):
+    assert pHashIndex.open(str(tmp_path), HASH_SIZE).__len__() == 0
+    index = pHashIndex(HASH_SIZE)
+    index.insert("a", np.zeros(HASH_SIZE * HASH_SIZE // 8, dtype=np.uint8))
+    index.save(get_index_path(str(tmp_path), HASH_SIZE))
+    assert pHashIndex.open(str(tmp_path), HASH_SIZE).ids == ["a"]
@@ -0,0 +1,26 @@
+from merkle import (PROOF_OUT_OF_RANGE, PROOF_VALID, pMerkleTree,
+                    deserialize_multiproof, serialize_multiproof, sha256,
+                    verify_proofs)
+
+
+def get_tree(n: int):
+    digests = [sha256(f"file-{idx}".encode()) for idx in range(n)]
+    tree = pMerkleTree()
+    tree.append_entries(digests)
+    leaves = [tree.hash_buff(digest) for digest in digests]
+    proofs = deserialize_multiproof(
+        serialize_multiproof(tree.prove_inclusion_batch()))
+    return bytes.fromhex(tree.m_get_root()), leaves, proofs
+
+
+def test_verify_proofs_valid():
+    root, leaves, proofs = get_tree(5)
+    assert verify_proofs(leaves, root, proofs) == [PROOF_VALID] * 5
+
+
+def test_verify_proofs_reports_count_mismatch():
+    root, leaves, proofs = get_tree(5)
+    assert verify_proofs(leaves[:4], root, proofs) == \
+        [PROOF_VALID] * 4 + [PROOF_OUT_OF_RANGE]
+    assert verify_proofs(leaves, root, proofs[:3]) == \
+        [PROOF_VALID] * 3 + [PROOF_OUT_OF_RANGE] * 2
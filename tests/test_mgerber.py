@@ -0,0 +1,125 @@
+import os
+from collections import namedtuple
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+from bithash import pBitHash
+from mconfig import config
+from phash_ctrl import pHashBaseController, phash_batch
+
+BOARD = os.path.join(os.path.dirname(__file__), "..", "assets", "original",
+                     "gerbers", "default2", "23K256-gerbers",
+                     "serial_sram_breakout")
+Layer = namedtuple("Layer", ["bounds"])
+
+
+def import_mgerber():
+    try:
+        import mgerber
+    except ImportError as e:
+        pytest.skip(f"pcb-tools unavailable: {e}")
+    return mgerber
+
+
+def get_mgerber():
+    """
+    Rendering needs libcairo and a pcb-tools that can read files on this
+    Python (0.1.6 opens them with the removed "rU" mode)
+    """
+    mgerber = import_mgerber()
+    try:
+        from gerber.render.cairo_backend import GerberCairoContext
+    except (ImportError, OSError) as e:
+        pytest.skip(f"cairo unavailable: {e}")
+    try:
+        mgerber.load_layer(f"{BOARD}.GTL")
+    except ValueError as e:
+        pytest.skip(f"pcb-tools cannot read gerbers here: {e}")
+    return mgerber
+
+
+def make_board(rng: np.random.Generator) -> tuple:
+    """
+    Two copper layers of traces and pads in board units (inch)
+    """
+    width, height = 1.0, rng.uniform(0.4, 1.0)
+    shapes = []
+    for _ in range(40):
+        x0, y0 = rng.uniform(0, width), rng.uniform(0, height)
+        if rng.random() < 0.6:
+            vertical = rng.random() < 0.5
+            x1 = x0 if vertical else rng.uniform(0, width)
+            y1 = rng.uniform(0, height) if vertical else y0
+            shapes.append((x0, y0, x1, y1, rng.uniform(0.008, 0.03),
+                           rng.integers(1, 3)))
+        else:
+            size = rng.uniform(0.02, 0.08)
+            shapes.append((x0, y0, x0 + size, y0 + size, 0,
+                           rng.integers(1, 3)))
+    return (width, height), shapes
+
+
+def draw_board(board: tuple, scale: float, supersample=1) -> Image.Image:
+    """
+    Raster of a synthetic board, supersampled to antialias like cairo
+    """
+    (width, height), shapes = board
+    size = (max(int(width * scale), 1), max(int(height * scale), 1))
+    scale *= supersample
+    img = Image.new("L", (size[0] * supersample, size[1] * supersample))
+    draw = ImageDraw.Draw(img)
+    for *xy, line_width, layer in shapes:
+        fill = 128 if layer == 1 else 255
+        xy = [v * scale for v in xy]
+        if line_width > 0:
+            draw.line(xy, fill=fill, width=max(round(line_width * scale), 1))
+        else:
+            draw.rectangle(xy, fill=fill)
+    return img.resize(size, Image.Resampling.BOX)
+
+
+def get_phash(img: Image.Image, hash_size: int) -> pBitHash:
+    pixels = pHashBaseController(hash_size).get_phash_pixels(img)
+    return pBitHash(phash_batch(pixels, hash_size)[0], hash_size * hash_size)
+
+
+@pytest.mark.parametrize("hash_size", [8, 16])
+def test_hash_scale_raster_within_tolerance(hash_size):
+    """
+    Synthetic boards rastered at get_hash_scale vs. at the png render
+    scale (1000). Measured with oversample 2 on these 50 boards:
+    hash 8 min 0.938 / mean 0.982, hash 16 min 0.961 / mean 0.988.
+    """
+    mgerber = import_mgerber()
+    job = mgerber.RenderJob("synthetic.png", 1000, [])
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        board = make_board(rng)
+        (width, height), _ = board
+        scale = mgerber.get_hash_scale(job, [Layer(((0, width), (0, height)))],
+                                       hash_size,
+                                       config["gerber_hash_oversample"])
+        direct = get_phash(draw_board(board, scale, 4), hash_size)
+        png = get_phash(draw_board(board, job.scale), hash_size)
+        assert direct.similarity(png) >= config["gerber_hash_tolerance"]
+
+
+def test_hash_scale_rejects_empty_layers():
+    mgerber = import_mgerber()
+    job = mgerber.RenderJob("empty.png", 1000, [])
+    with pytest.raises(ValueError, match="empty.png"):
+        mgerber.get_hash_scale(job, [Layer(((1, 1), (2, 2)))], 8, 2)
+
+
+@pytest.mark.parametrize("hash_size", [8, 16])
+def test_direct_hash_within_tolerance(tmp_path, hash_size):
+    mgerber = get_mgerber()
+    job = mgerber.RenderJob(str(tmp_path / "board.png"), 1000, [
+        (f"{BOARD}.GTL", mgerber.Colors.black, mgerber.color_for_layer(1, 2)),
+        (f"{BOARD}.GBL", mgerber.Colors.transparent,
+         mgerber.color_for_layer(2, 2)),
+    ])
+    rows = mgerber.check_hash_tolerance([job], str(tmp_path / "state.json"),
+                                        hash_size)
+    (_, hamming, similarity, ok), = rows
+    assert ok, f"similarity {similarity} below {config['gerber_hash_tolerance']}"
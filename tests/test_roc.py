@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import roc
+from bithash import pBitHash
+
+HASH_SIZE = 8
+
+
+def make_table(image_set: str, modules: int, seed: int) -> pd.DataFrame:
+    """
+    Average table rows: per module an APH and variants with flipped bits
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for m in range(modules):
+        aph = rng.random(HASH_SIZE * HASH_SIZE) > 0.5
+        for v, value in enumerate(("na", "0.5", "2", "rotate_90")):
+            bits = aph.copy()
+            bits[rng.choice(bits.size, v * 3, replace=False)] ^= True
+            rows.append({
+                "name": f"{image_set}{m}",
+                "phash": str(pBitHash.from_bool(bits)),
+                "ave-hash": str(pBitHash.from_bool(aph)),
+                "ham": v * 3,
+                "ham-max": HASH_SIZE * HASH_SIZE,
+                "norm": 1.0 - v * 3 / (HASH_SIZE * HASH_SIZE),
+                "mod": "res",
+                "value": value,
+                "image_set": image_set,
+                "module": f"{image_set}-module{m}",
+                "valid": True
+            })
+    return pd.DataFrame(rows)
+
+
+def test_rates_match_brute_force():
+    df = make_table("single", 6, 0)
+    curve = roc.from_table(df, HASH_SIZE)
+    genuine = df[df["value"] != "na"]["norm"].to_numpy()
+    for threshold in (0.8, 0.9, 0.95):
+        far, frr = curve.rates([threshold])
+        assert np.isclose(frr[0], (genuine < threshold).mean())
+    assert curve.genuine.sum() == genuine.size
+    assert curve.impostor.sum() == 6 * 5 // 2
+
+
+def test_store_curve_is_per_image_set(tmp_path):
+    from hash_store import open_store
+
+    single, versions = make_table("single", 5, 1), make_table("versions", 3, 2)
+    store = open_store(str(tmp_path), HASH_SIZE)
+    store.append_frame(pd.concat([single, versions], ignore_index=True))
+
+    for image_set, df in (("single", single), ("versions", versions)):
+        stored = roc.from_store(str(tmp_path), HASH_SIZE, image_set)
+        expected = roc.from_table(df, HASH_SIZE)
+        assert (stored.genuine == expected.genuine).all()
+        assert (stored.impostor == expected.impostor).all()
+    assert roc.get_curves("cropped", [HASH_SIZE], str(tmp_path)) == {}
@@ -0,0 +1,14 @@
+import runner
+from mconfig import config
+
+
+def test_build_pipeline_leaves_config_alone(monkeypatch):
+    monkeypatch.setitem(config, "report_formats", ["feather"])
+    monkeypatch.setitem(config, "report_excel", False)
+    before = dict(config)
+    runner.build_pipeline([8, 16], ["single"], in_memory=True)
+    assert config == before
+    assert runner.get_pipeline_settings(False) == {
+        "report_formats": ["feather", "parquet"],
+        "report_excel": False
+    }
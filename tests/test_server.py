@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import zipfile
+from glob import glob
+from io import BytesIO
+import pytest
+from mconfig import config
+from server import pFingerprintClient, pFingerprintServer
+
+ASSETS = os.path.join(os.path.dirname(__file__), "..", "assets", "original")
+HASH_SIZE = 8
+
+
+def get_files() -> list:
+    files = sorted(glob(os.path.join(ASSETS, "single", "*.png")))[:3]
+    if files.__len__() == 0:
+        pytest.skip("No sample images")
+    return files + [os.path.join(os.path.dirname(__file__), "conftest.py")]
+
+
+def run_with_server(test, **kwargs):
+    """
+    Runs test(server, client) against a server on an ephemeral port
+    """
+
+    async def main():
+        server = pFingerprintServer(workers=1, hash_size=HASH_SIZE, **kwargs)
+        tcp = await server.start("127.0.0.1", 0)
+        port = tcp.sockets[0].getsockname()[1]
+        try:
+            return await test(server, pFingerprintClient("127.0.0.1", port))
+        finally:
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_manifest_matches_ingest_asset():
+    from image_ctrl import pImageController
+    from mhash_ctrl import MultiHashController
+
+    files = get_files()
+    config["hash_size"] = HASH_SIZE
+    expected = json.loads(
+        MultiHashController(pImageController(config), config).ingest_asset(files))
+
+    async def test(server, client):
+        return await asyncio.gather(client.fingerprint(files),
+                                    client.fingerprint(files[:1]))
+
+    (status, manifest), (status_single, single) = run_with_server(test)
+    assert status == 200 and status_single == 200
+    assert manifest == expected
+    assert manifest["files"][-1]["phash"] is None  # Merkle leaf only
+    assert single["average_phash:"] == manifest["files"][0]["phash"]
+
+
+def test_full_queue_is_rejected():
+    files = get_files()
+
+    async def test(server, client):
+        server.batcher.cancel()  # Nothing drains the queue
+        server.queue.put_nowait(([], asyncio.get_running_loop().create_future()))
+        status, payload = await client.fingerprint(files)
+        return status, payload, (await client.metrics())["rejected"]
+
+    status, payload, rejected = run_with_server(test, queue_size=1)
+    assert status == 503
+    assert rejected == 1
+
+
+def test_bad_input_is_rejected():
+    empty = BytesIO()
+    zipfile.ZipFile(empty, "w").close()
+
+    async def test(server, client):
+        return [(await client.request("POST", "/fingerprint", body))[0]
+                for body in (b"not a zip", empty.getvalue())]
+
+    assert run_with_server(test) == [400, 400]
+
+
+def test_oversized_bundle_is_rejected_before_unpacking(monkeypatch):
+    monkeypatch.setitem(config, "server_max_unpacked", 1 << 20)
+    bomb = BytesIO()
+    with zipfile.ZipFile(bomb, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("zeros.png", bytes(2 << 20))
+
+    async def test(server, client):
+        status, payload = await client.request("POST", "/fingerprint",
+                                               bomb.getvalue())
+        return status, (await client.metrics())["errors"]
+
+    assert run_with_server(test) == (413, 1)
+
+
+def test_path_mode_stays_below_file_root():
+    files = get_files()
+    root = os.path.dirname(files[0])
+
+    async def test(server, client):
+        inside = await client.fingerprint_paths([os.path.basename(files[0])])
+        outside = await client.fingerprint_paths(["../../../../etc/hostname"])
+        absolute = await client.fingerprint_paths(["/etc/hostname"])
+        return inside[0], outside[0], absolute[0]
+
+    assert run_with_server(test, file_root=root) == (200, 403, 403)
+
+    async def disabled(server, client):
+        return (await client.fingerprint_paths([files[0]]))[0]
+
+    assert run_with_server(disabled) == 403
+
+
+def test_recovers_from_dead_worker():
+    files = get_files()[:1]
+
+    async def test(server, client):
+        assert (await client.fingerprint(files))[0] == 200
+        for process in list(server.executor._processes.values()):
+            process.kill()
+        broken = (await client.fingerprint(files))[0]
+        return broken, (await client.fingerprint(files))[0]
+
+    broken, recovered = run_with_server(test)
+    assert broken == 500
+    assert recovered == 200
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import runner
+from mconfig import config
+from report_sink import pColumnarSink, read_report
+from stats import group_stats
+
+
+def make_average(seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "mod": rng.choice(["res", "crop", "rotate"], 60),
+        "norm": rng.random(60),
+        "valid": rng.random(60) > 0.3
+    })
+
+
+def test_group_stats_matches_groupby():
+    df = make_average(0)
+    stats = group_stats(df).set_index("mod")
+    grouped = df.groupby("mod")
+    assert (stats["rows"] == grouped.size()).all()
+    assert np.allclose(stats["valid_rate"], grouped["valid"].mean())
+    assert np.allclose(stats["mean"], grouped["norm"].mean())
+    assert np.allclose(stats["median"], grouped["norm"].median())
+
+
+def test_stats_stage_writes_per_hash_size(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "reports_output", str(tmp_path))
+    monkeypatch.setitem(config, "report_formats", ["parquet"])
+    monkeypatch.setitem(config, "report_excel", False)
+    sink = pColumnarSink(str(tmp_path))
+    for hash_size in (8, 16, 32):
+        sink.write(make_average(hash_size), "average", "single", hash_size)
+
+    runner.stage_stats("single", [8, 16])
+    stats = read_report("stats", "single")
+    assert sorted(stats["hash_size"].unique()) == [8, 16]
+    expected = group_stats(make_average(16)).set_index("mod")
+    written = stats[stats["hash_size"] == 16].set_index("mod")
+    assert (written["rows"] == expected["rows"]).all()
+    assert np.allclose(written["mean"], expected["mean"])
+    stages = runner.build_pipeline([8], ["single"], mpls=False, report=False)
+    assert "stats:single" in [stage.name for stage in stages]